@@ -1,61 +1,43 @@
 
 # from datetime import datetime,timedelta
-import datetime
 import logging
 import sqlite3
 import csv
 import sys
 
+import wsprdb
+
+from spot import make_spot, parse_minute, format_minute, parse_freq, format_freq
 
-def balloonstodb(balloons):
-        con = None
 
+def balloonstodb(balloons):
         logging.info("Writing balloons do db")
         try:
-            con = sqlite3.connect('wsprdb.db')
-            cur = con.cursor()
-            cur.execute('drop table if exists balloons')
-            cur.execute('create table if not exists balloons(name varchar(20), call varchar(10), freq integer, channel integer)')
+            wsprdb.execute('delete from balloons')
+            wsprdb.executemany("INSERT INTO balloons VALUES(?,?,?,?)", [row[:4] for row in balloons])
             for row in balloons:
-                cur.execute("INSERT INTO balloons VALUES(?,?,?,?)", (row))
                 logging.info(row)
-            data = cur.fetchall()
-            if not data:
-                con.commit()
+            wsprdb.commit()
         except sqlite3.Error as e:
                 logging.info("Database error: %s",e)
         except Exception as e:
-                logging.info("Exception in _query:", e)
-        finally:
-            if con:
-                con.close()
+                logging.info("Exception in _query: %s", e)
         return
 
 
 def readballoonsdb():
-    con = None
     balloons = []
-    data = []
 
     logging.info("Reading balloons from db")
     try:
-        con = sqlite3.connect('wsprdb.db')
-        cur = con.cursor()
-        cur.execute('select * from balloons')
-        data = cur.fetchall()
+        data = wsprdb.execute('select * from balloons')
         for row in data:
             logging.info(row)
             balloons.append(list(row))
-
-        if not data:
-            con.commit()
     except sqlite3.Error as e:
         logging.info("Database error: %s" % e)
     except Exception as e:
         logging.info("Exception in _query: %s" % e)
-    finally:
-        if con:
-            con.close()
 #    logging.info("Loaded balloons:", len(balloons))
     return balloons
 
@@ -66,8 +48,7 @@ def dumpcsv(spotlist):
         spotswriter = csv.writer(csvfile, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
 
         for row in spotlist:
-            row[0] = datetime.datetime.strftime(row[0], '%Y-%m-%d %H:%M')
-            spotswriter.writerow(row)
+            spotswriter.writerow([format_minute(row.time), row.call, format_freq(row.freq)] + list(row[3:10]))
 
         csvfile.close()
     return
@@ -89,27 +70,43 @@ def dumpcsv(spotlist):
 
 #  timestamp, tx_call, freq real, snr integer, drift integer, tx_loc, power , rx_call, rx_loc, distance
 
-def readcsv(csv_file):
-        spots = []
+#
+# Spots of csv_file one at a time, for readcsv() and the streaming pipeline
+#
+# since/until limit the spots to a time range. Time is compared on the raw
+# string before it is parsed. If the file is known to be sorted on time,
+# ordered=True stops reading at the first row past until.
+#
+def iter_csv(csv_file, since=None, until=None, ordered=False):
+        since_str = since.strftime('%Y-%m-%d %H:%M') if since else None
+        until_str = until.strftime('%Y-%m-%d %H:%M') if until else None
+
         with open(csv_file, newline='') as csvfile:
                 spotsreader = csv.reader(csvfile, delimiter=',', quotechar='|')
 
                 for row in spotsreader:
-                        # Time
-                        row[0] = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M')
-                        row[3] = int(row[3])
-                        row[4] = int(row[4])
-                        
-                        # Strip "+" from dB
-                        row[6] = int(row[6].replace('+',''))
-                        row[9] = int(row[9])
-                        
-                        # logging.info(row)
-                        spots.append(row)
+                        if until_str and row[0] > until_str:
+                                if ordered:
+                                        logging.info("readcsv() Passed %s, stop reading", until)
+                                        break
+                                continue
+                        if since_str and row[0] < since_str:
+                                continue
+
+                        # Time, and strip "+" from dB
+                        yield make_spot(parse_minute(row[0]), row[1], parse_freq(row[2]), int(row[3]), int(row[4]), row[5],
+                                        int(row[6].replace('+','')), row[7], row[8], int(row[9]))
+
+
+#
+# All spots of csv_file in a list, see iter_csv()
+#
+def readcsv(csv_file, since=None, until=None, ordered=False):
+        spots = list(iter_csv(csv_file, since, until, ordered))
 
-        csvfile.close()
         logging.info("Loaded spots: %s", len(spots))
-        logging.info("First",spots[1:][0])
-        logging.info("Last",spots[-1:][0])
+        if spots:
+                logging.info("First: %s", spots[0])
+                logging.info("Last: %s", spots[-1])
 
         return spots
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+#
+# Batch decoding of WSPR telemetry with NumPy
+#
+# Same decoding as decode_telemetry() in telemetry.py, but for arrays of
+# position/telemetry pairs at once. Meant for backfill and archive
+# reprocessing where hundreds of thousands of pairs are decoded.
+#
+# Run this file to cross-check against decode_telemetry() for every
+# telemetry call, every telemetry locator/power and every position locator.
+#
+
+import logging
+import sys
+import time
+
+import numpy as np
+
+from spot import Spot
+from telemetry import pow2dec, decode_telemetry
+
+# Power to decimal conversion as lookup array, -1 for invalid power levels
+pow2dec_lut = np.full(max(pow2dec) + 1, -1, dtype=np.int64)
+for k, v in pow2dec.items():
+    pow2dec_lut[k] = v
+
+
+#
+# Convert a sequence of strings to an (n, width) array of character codes
+#
+def _chars(strings, width):
+    a = np.asarray(strings, dtype='U%d' % width)
+    return a.view(np.uint32).reshape(len(a), width).astype(np.int64)
+
+
+#
+# Decode telemetry from arrays of telemetry calls, locators and powers and
+# the locators of the matching position packets.
+#
+# Returns a dict of arrays with the same keys and values as decode_telemetry(),
+# except time and call which are taken from the position spots by the caller.
+#
+def decode_telemetry_batch(tele_calls, tele_locs, tele_powers, pos_locs):
+    n = len(tele_calls)
+
+    # Convert call to numbers
+    call = _chars(tele_calls, 6)
+    c1 = call[:, 1]
+    c1 = np.where(c1 >= 65, c1 - 55, c1 - 48)
+    c2 = call[:, 3] - 65
+    c3 = call[:, 4] - 65
+    c4 = call[:, 5] - 65
+
+    # Convert locator to numbers
+    tloc = _chars(tele_locs, 4)
+    l1 = tloc[:, 0] - 65
+    l2 = tloc[:, 1] - 65
+    l3 = tloc[:, 2] - 48
+    l4 = tloc[:, 3] - 48
+
+    # Convert power
+    p = pow2dec_lut[np.asarray(tele_powers, dtype=np.int64)]
+    if (p < 0).any():
+        raise KeyError("decode_telemetry_batch() Invalid power level")
+
+    sum1_tot = c1*26*26*26 + c2*26*26 + c3*26 + c4
+    sum2_tot = l1*18*10*10*19 + l2*10*10*19 + l3*10*19 + l4*19 + p
+
+    # 24*1068
+    lsub1 = sum1_tot // 25632
+    lsub2_tmp = sum1_tot - lsub1*25632
+    lsub2 = lsub2_tmp // 1068
+
+    alt = (lsub2_tmp - lsub2*1068)*20
+
+    # Handle bogus altitudes, same rules as decode_telemetry()
+    alt = np.where(alt > 15000, 9999, alt)
+    alt = np.where(alt == 2760, 9998, alt)
+    alt = np.where(alt == 0, 10000, alt)
+
+    # Temperature
+    temp_1 = sum2_tot // 6720
+    temp_2 = temp_1*2 + 457
+    temp = (temp_2*500/1024) - 273
+
+    # Battery
+    batt_1 = sum2_tot - temp_1*6720
+    batt_2 = batt_1 // 168
+    batt = batt_2/10
+
+    # Speed / GPS / Sats
+    t3 = batt_1 - batt_2*168
+    t4 = t3 // 4
+    speed = t4*5
+    r7 = t3 - t4*4
+    gps = r7 // 2
+    sats = r7 % 2
+
+    # Locator of position packet plus sublocator, lower case as in decode_telemetry()
+    ploc = _chars(pos_locs, 4)
+    loc = np.empty((n, 6), dtype=np.uint32)
+    loc[:, :4] = ploc
+    loc[:, 4] = lsub1 + 97
+    loc[:, 5] = lsub2 + 97
+    loc = loc.view('U6').reshape(n)
+
+    # Calc lat/lon from loc+subloc, same order of operations as maidenhead.toLoc()
+    ploc = np.where((ploc >= 97) & (ploc <= 122), ploc - 32, ploc)
+    lon = (-180 + (ploc[:, 0] - 65)*20 + (ploc[:, 2] - 48)*2).astype(np.float64)
+    lat = (-90 + (ploc[:, 1] - 65)*10 + (ploc[:, 3] - 48)*1).astype(np.float64)
+    lon = lon + lsub1 * 5./60 + 2.5/60
+    lat = lat + lsub2 * 2.5/60 + 1.25/60
+
+    telemetry = {"lat":lat, "lon":lon, "loc":loc, "alt":alt,
+                 "temp":np.round(temp, 1), "batt":np.round(batt, 3), "speed":speed, "gps":gps, "sats":sats }
+
+    return telemetry
+
+
+#
+# Compare batch decoding with decode_telemetry() for one set of pairs
+#
+def _compare(tele_calls, tele_locs, tele_powers, pos_locs):
+    batch = decode_telemetry_batch(tele_calls, tele_locs, tele_powers, pos_locs)
+
+    errors = 0
+    for i in range(len(tele_calls)):
+        spot_pos = Spot(0, 'CALL', 0, 0, 0, pos_locs[i], 0, '', '', 0)
+        spot_tele = Spot(0, tele_calls[i], 0, 0, 0, tele_locs[i], tele_powers[i], '', '', 0)
+        t = decode_telemetry(spot_pos, spot_tele)
+        for k in batch:
+            if t[k] != batch[k][i]:
+                if errors < 10:
+                    logging.info("crosscheck() Mismatch %s %s %s %s %s: %s != %s", tele_calls[i], tele_locs[i],
+                                 tele_powers[i], pos_locs[i], k, t[k], batch[k][i])
+                errors += 1
+    return errors
+
+
+#
+# Cross-check against decode_telemetry(). The call only affects alt and
+# sublocator, the telemetry locator and power only affect temp, batt, speed,
+# gps and sats. So each is checked for all its values with the other fixed,
+# and the position locator is cycled through all its values meanwhile.
+#
+def crosscheck():
+    A = [chr(c) for c in range(ord('A'), ord('Z') + 1)]
+    D = [chr(c) for c in range(ord('0'), ord('9') + 1)]
+    L = A[:18]
+
+    pos_locs = [a + b + c + d for a in L for b in L for c in D for d in D]
+    calls = ['0' + c1 + '9' + c2 + c3 + c4 for c1 in D + A for c2 in A for c3 in A for c4 in A]
+    locpow = [(loc, power) for loc in pos_locs for power in sorted(pow2dec)]
+
+    # Keep decode_telemetry() quiet
+    logging.disable(logging.INFO)
+    tstart = time.time()
+    errors = _compare(calls, ['JO22'] * len(calls), [23] * len(calls),
+                      [pos_locs[i % len(pos_locs)] for i in range(len(calls))])
+    errors += _compare(['0A9BCD'] * len(locpow), [l for l, p in locpow], [p for l, p in locpow],
+                       [pos_locs[i % len(pos_locs)] for i in range(len(locpow))])
+    logging.disable(logging.NOTSET)
+
+    logging.info("crosscheck() Checked %d calls and %d locator/power pairs in %.1f s, %d mismatches",
+                 len(calls), len(locpow), time.time() - tstart, errors)
+    return errors == 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(0 if crosscheck() else 1)
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+#
+# Benchmark the APRS-IS session against a local stand-in server
+#
+# Runs a small APRS-IS stand-in on localhost that takes the login, sends a
+# comment line now and then like the real servers, and counts the lines it
+# gets. Sends packets over one APRSISClient session without rate limit and
+# with the configured aprsRate, and checks that all arrived over one
+# connection and the rate limit held. Then points a client at a server that
+# never answers the connect, and checks that stats() doesn't wait for the
+# send that is stuck connecting.
+#
+# Needs balloon.ini in the current directory, like sonde_to_aprs.py.
+#
+# Usage: bench_aprsis.py [packets]
+#
+
+import logging
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from sonde_to_aprs import APRSISClient, aprsRate
+
+
+#
+# Stand-in server, one thread per connection
+#
+class StandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.wfile.write(b"# aprsc stand-in\r\n")
+
+        login = self.rfile.readline().decode('utf-8', 'replace')
+        if not login.startswith('user '):
+            return
+        self.wfile.write(b"# logresp N0CALL verified, server STANDIN\r\n")
+
+        for line in self.rfile:
+            with server.lock:
+                server.lines.append(line.decode('utf-8', 'replace').strip())
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.lines = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def wait_lines(self, n, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if len(self.lines) >= n:
+                    return True
+            time.sleep(0.01)
+        return False
+
+
+def run(nrpackets, rate):
+    server = StandInServer()
+    client = APRSISClient(host='127.0.0.1', port=server.server_address[1], user='N0CALL', passcode='-1', rate=rate)
+
+    packets = ["N0CALL>APRS:;BALLOON  *111111z0000.00N/00000.00EO000/000/A=000000 Packet %d" % i for i in range(nrpackets)]
+    tstart = time.time()
+    sent = sum(1 for p in packets if client.send_packet(p))
+    tsend = time.time() - tstart
+
+    ok = server.wait_lines(nrpackets) and server.lines == packets and server.connections == 1
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+    logging.info("  Rate limit: %-5s Sent: %d in %.2f s, %.1f p/s, Connections: %d, All received in order: %s",
+                 rate or "none", sent, tsend, sent / max(tsend, 0.001), server.connections, ok)
+    logging.info("  %s", client.stats())
+
+    # One packet goes right away, then one per interval
+    if rate > 0 and nrpackets > 1 and tsend < (nrpackets - 1) / rate * 0.95:
+        logging.info("  Rate limit not held")
+        ok = False
+    return ok
+
+
+#
+# Server whose accept queue is full, so connects hang until the timeout
+#
+def dead_server():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    fillers = []
+    for i in range(4):
+        s = socket.socket()
+        s.setblocking(False)
+        s.connect_ex(listener.getsockname())
+        fillers.append(s)
+    return listener, fillers
+
+
+def check_dead_server(timeout=2):
+    listener, fillers = dead_server()
+    client = APRSISClient(host='127.0.0.1', port=listener.getsockname()[1], user='N0CALL', passcode='-1', rate=0, timeout=timeout)
+
+    sender = threading.Thread(target=client.send_packet, args=("N0CALL>APRS:>test",), daemon=True)
+    sender.start()
+    time.sleep(0.2)
+
+    tstart = time.time()
+    stats = client.stats()
+    tstats = time.time() - tstart
+
+    sender.join()
+    ok = tstats < 0.1
+    logging.info("  Dead server: stats() took %.3f s while a send was connecting: %s", tstats, ok)
+    logging.info("  %s", client.stats())
+
+    client.close()
+    for s in fillers:
+        s.close()
+    listener.close()
+    return ok
+
+
+def main():
+    nrpackets = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    logging.info("APRS-IS stand-in, %d packets", nrpackets)
+    ok = run(nrpackets, 0)
+    # Limited run kept to a few seconds
+    rate = aprsRate if aprsRate > 0 else 1.0
+    ok = run(min(nrpackets, int(rate * 5) + 1), rate) and ok
+    ok = check_dead_server() and ok
+    logging.info("All checks passed: %s", ok)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+#
+# Benchmark parsing of old database pages from wsprnet.org
+#
+# Compares the streaming OlddbTableParser with the BeautifulSoup parsing
+# used before, on saved olddb pages, for rows/s and peak memory, and checks
+# both give the same rows. Without files a page of synthetic spots is used.
+#
+# Save a page with:
+#   wget -O olddb.html 'http://wsprnet.org/olddb?mode=html&band=20&limit=10000&findcall=&findreporter=&sort=spotnum'
+#
+# Usage: bench_olddb.py [page.html ...]
+#
+
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from wsprnet import OlddbTableParser
+
+
+def soup_rows(text):
+    soup = BeautifulSoup(text, 'html.parser')
+
+    data = []
+    table = soup.find_all('table')[2]
+    rows = table.find_all('tr')
+    for row in rows:
+        cols = row.find_all('td')
+        cols = [ele.text.strip() for ele in cols]
+        data.append([ele for ele in cols if ele])
+
+    return [ele for ele in data if ele]
+
+
+def stream_rows(text):
+    chunks = (text[i:i + 65536] for i in range(0, len(text), 65536))
+    return list(OlddbTableParser().parse(chunks))
+
+
+def synthetic_page(nrspots):
+    random.seed(1)
+    rows = []
+    for i in range(nrspots):
+        rows.append('<tr id="evenrow"><td align=left>&nbsp;2020-11-04 14:%02d&nbsp;</td><td align=left>&nbsp;DL%dABC&nbsp;</td>'
+                    '<td align=right>&nbsp;14.0970%02d&nbsp;</td><td align=right>&nbsp;%d&nbsp;</td><td align=right>&nbsp;0&nbsp;</td>'
+                    '<td align=left>&nbsp;JO62&nbsp;</td><td align=right>&nbsp;+37&nbsp;</td><td align=right>&nbsp;5.012&nbsp;</td>'
+                    '<td align=left>&nbsp;G%dXYZ&nbsp;</td><td align=left>&nbsp;IO91&nbsp;</td><td align=right>&nbsp;1011&nbsp;</td>'
+                    '<td align=right>&nbsp;628&nbsp;</td></tr>\n' %
+                    (i % 60, i % 10, random.randint(0, 99), random.randint(-30, 5), random.randint(0, 9)))
+    return ('<html><body><table><tr><td>wsprnet</td></tr></table>\n'
+            '<table><tr><td><form>Band <select><option>20</option></select></form></td></tr></table>\n'
+            '<table><tr><th>&nbsp;Date&nbsp;</th><th>&nbsp;Call&nbsp;</th><th>&nbsp;MHz&nbsp;</th></tr>\n' +
+            ''.join(rows) + '</table></body></html>\n')
+
+
+#
+# Time without tracing, then run again for peak memory
+#
+def measure(func, text):
+    tstart = time.time()
+    rows = func(text)
+    t = time.time() - tstart
+
+    tracemalloc.start()
+    func(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return rows, t, peak
+
+
+def main():
+    pages = []
+    for f in sys.argv[1:]:
+        with open(f, encoding='utf-8', errors='replace') as page:
+            pages.append((f, page.read()))
+    if not pages:
+        pages.append(("synthetic", synthetic_page(10000)))
+
+    for name, text in pages:
+        r1, t1, m1 = measure(soup_rows, text)
+        r2, t2, m2 = measure(stream_rows, text)
+        logging.info("%s: Rows: %d Same: %s", name, len(r2), r1 == r2)
+        logging.info("  BeautifulSoup: %8.0f rows/s Peak: %6.1f MB", len(r1) / max(t1, 0.000001), m1 / 1e6)
+        logging.info("  Streaming:     %8.0f rows/s Peak: %6.1f MB", len(r2) / max(t2, 0.000001), m2 / 1e6)
+        if r1 != r2:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(main())
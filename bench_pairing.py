@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+#
+# Benchmark pairing of position and telemetry spots
+#
+# Builds a window of spots from a number of balloons, each transmitting a
+# position every 10 minutes heard by a number of reporters, followed by its
+# telemetry packet 2 minutes later. Compares pair_telemetry() with the old
+# scan of the telemetry list and checks that both give the same pairs.
+#
+# Usage: bench_pairing.py [hours] [balloons] [reporters]
+#
+
+import datetime
+import logging
+import random
+import sys
+import time
+
+from spot import Spot, epoch_minute
+from telemetry import pair_telemetry
+
+
+#
+# The old pairing, scan telemetry from the start for every position spot
+#
+def scan_pairs(bspots, telem):
+    pairs = []
+    spot_oldtime = None
+    for row in bspots:
+        spot_time = row.time
+        if spot_time == spot_oldtime:
+            continue
+        spot_oldtime = spot_time
+
+        b_telem = []
+        for trow in telem:
+            tdiff = trow.time - spot_time
+            if tdiff > 8:
+                break
+            if tdiff > 0:
+                b_telem.append(trow)
+        pairs.append((row, b_telem))
+    return pairs
+
+
+def make_spots(hours, nrballoons, nrreporters):
+    random.seed(1)
+    start = epoch_minute(datetime.datetime(2020, 11, 4, 0, 0))
+    spots = []
+    for b in range(nrballoons):
+        call = "B%dXX" % b
+        slot = b % 5
+        for m in range(0, hours * 60, 10):
+            t = start + m + slot * 2
+            for r in range(nrreporters):
+                spots.append(Spot(t, call, 14097100, -20, 0, 'JO22', 23, 'R%d' % r, 'JO31', 500))
+                spots.append(Spot(t + 2, '0A9BCD', 14097100, -20, 0, 'JO22', 23, 'R%d' % r, 'JO31', 500))
+    spots.sort()
+    return spots
+
+
+def main():
+    hours = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    nrballoons = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    nrreporters = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    spots = make_spots(hours, nrballoons, nrreporters)
+    telem = [r for r in spots if r.call == '0A9BCD']
+    logging.info("Spots: %d Telemetry: %d Hours: %d Balloons: %d Reporters: %d", len(spots), len(telem), hours, nrballoons, nrreporters)
+
+    t_scan = 0
+    t_bisect = 0
+    for b in range(nrballoons):
+        bspots = [r for r in spots if r.call == "B%dXX" % b]
+
+        tstart = time.time()
+        p1 = scan_pairs(bspots, telem)
+        t_scan += time.time() - tstart
+
+        tstart = time.time()
+        p2 = pair_telemetry(bspots, telem)
+        t_bisect += time.time() - tstart
+
+        if p1 != p2:
+            logging.info("Pairs differ for balloon %d!", b)
+            return 1
+
+    logging.info("Scan: %.3f s Bisect: %.3f s Speedup: %.1fx", t_scan, t_bisect, t_scan / max(t_bisect, 0.000001))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(main())
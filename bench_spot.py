@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+#
+# Benchmark memory per spot, old spot lists against Spot records
+#
+# Makes olddb-like rows of text cells, each cell a new string like from the
+# page parser, and converts them the way readolddb() did before, to a list
+# with a datetime, and now, to a Spot. Memory is measured for the spots and
+# for the same spots held in a SpotCache.
+#
+# Usage: bench_spot.py [spots]
+#
+
+import datetime
+import logging
+import random
+import sys
+import tracemalloc
+
+from spot import make_spot, epoch_minute, parse_freq
+from spotcache import SpotCache
+
+
+def make_rows(nrspots):
+    random.seed(1)
+    start = datetime.datetime(2020, 11, 4, 12, 0)
+    calls = ["DL%dABC" % i for i in range(2000)]
+    reporters = ["G%dXYZ" % i for i in range(1000)]
+
+    rows = []
+    for i in range(nrspots):
+        t = start + datetime.timedelta(minutes=random.randrange(0, 120, 2))
+        # ''.join gives a new string object per cell, like the parser does
+        rows.append([''.join(c) for c in (t.strftime('%Y-%m-%d %H:%M'), random.choice(calls), '14.0971%02d' % random.randint(0, 99),
+                     str(random.randint(-30, 5)), str(random.randint(-1, 1)), 'JO62', '+%d' % random.choice([23, 27, 30, 37]),
+                     random.choice(reporters), 'IO91', str(random.randint(100, 9000)))])
+    return rows
+
+
+def old_spot(row):
+    return [datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M'), row[1], row[2], row[3], row[4], row[5],
+            int(row[6].replace('+', '')), row[7], row[8], row[9]]
+
+
+def new_spot(row):
+    return make_spot(epoch_minute(datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M')), row[1], parse_freq(row[2]),
+                     int(row[3]), int(row[4]), row[5], int(row[6].replace('+', '')), row[7], row[8], int(row[9]))
+
+
+#
+# Memory allocated while building the spots, the text cells are copied so
+# they are counted as they would be coming from the parser
+#
+def measure(convert, rows, cache=False):
+    tracemalloc.start()
+    spots = [convert([''.join(c) for c in row]) for row in rows]
+    if cache:
+        c = SpotCache(max_size=len(spots) + 1)
+        c.update(spots)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def main():
+    nrspots = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = make_rows(nrspots)
+
+    m_old = measure(old_spot, rows)
+    m_new = measure(new_spot, rows)
+    m_cache = measure(new_spot, rows, cache=True)
+
+    logging.info("Spots: %d", nrspots)
+    logging.info("  List:            %6.0f bytes/spot", m_old / nrspots)
+    logging.info("  Spot:            %6.0f bytes/spot", m_new / nrspots)
+    logging.info("  Spot + cache:    %6.0f bytes/spot", m_cache / nrspots)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(main())
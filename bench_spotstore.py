@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+#
+# Benchmark memory and filtering of a month of spots, lists against SpotStore
+#
+# Makes a month of synthetic spots from a few thousand stations and keeps them
+# as the old list of lists (datetime and text frequency), as a list of Spots
+# and as a SpotStore. Reports memory of each and the time to select the spots
+# of a few calls on one band in a two day range, and checks the selections
+# are the same.
+#
+# Usage: bench_spotstore.py [spots]
+#
+
+import datetime
+import gc
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+from spot import make_spot, epoch_minute, minute_datetime, format_freq
+from spotstore import SpotStore
+
+bands = [(7, 7040000), (10, 10140100), (14, 14097000), (28, 28126000)]
+
+
+def make_spots(nrspots):
+    random.seed(1)
+    start = epoch_minute(datetime.datetime(2020, 11, 1))
+    calls = ["DL%dABC" % i for i in range(3000)]
+    reporters = ["G%dXYZ" % i for i in range(1500)]
+    locs = ["%s%s%d%d" % (a, b, c, d) for a in "IJKL" for b in "NOP" for c in range(10) for d in range(10)]
+
+    for i in range(nrspots):
+        band, base = random.choice(bands)
+        yield make_spot(start + random.randrange(0, 30 * 24 * 60, 2), random.choice(calls), base + random.randint(0, 200),
+                        random.randint(-30, 5), random.randint(-1, 1), random.choice(locs), random.choice([23, 27, 30, 37]),
+                        random.choice(reporters), random.choice(locs), random.randint(100, 9000))
+
+
+#
+# Old readers made new strings for every row, ''.join does the same
+#
+def old_row(s):
+    return [minute_datetime(s.time), ''.join(s.call), format_freq(s.freq), s.snr, s.drift, ''.join(s.loc), s.power,
+            ''.join(s.reporter), ''.join(s.reporter_loc), s.distance]
+
+
+def traced(func):
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+
+def timed(func):
+    tstart = time.time()
+    result = func()
+    return result, time.time() - tstart
+
+
+def main():
+    nrspots = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    spots, m_spots = traced(lambda: list(make_spots(nrspots)))
+    lists, m_lists = traced(lambda: [old_row(s) for s in spots])
+    store, m_store = traced(lambda: SpotStore.from_spots(iter(spots)))
+
+    logging.info("Spots: %d", nrspots)
+    logging.info("  List of lists: %7.1f MB %5.0f bytes/spot", m_lists / 1e6, m_lists / nrspots)
+    logging.info("  List of Spots: %7.1f MB %5.0f bytes/spot", m_spots / 1e6, m_spots / nrspots)
+    logging.info("  SpotStore:     %7.1f MB %5.0f bytes/spot", m_store / 1e6, m_store / nrspots)
+
+    # A few calls on 20m over two days
+    calls = set("DL%dABC" % i for i in range(0, 3000, 300))
+    since = datetime.datetime(2020, 11, 10)
+    until = datetime.datetime(2020, 11, 12)
+    since_m = epoch_minute(since)
+    until_m = epoch_minute(until)
+
+    r_lists, t_lists = timed(lambda: [r for r in lists if r[1] in calls and r[2].partition('.')[0] == '14' and since <= r[0] <= until])
+    r_spots, t_spots = timed(lambda: [s for s in spots if s.call in calls and s.freq // 1000000 == 14 and since_m <= s.time <= until_m])
+    r_store, t_store = timed(lambda: store.select(calls=calls, bands=[14], since=since_m, until=until_m))
+
+    logging.info("Select %d calls on 20m over 2 days: %d spots, Same: %s", len(calls), len(r_store),
+                 len(r_lists) == len(r_spots) and r_spots == list(r_store))
+    logging.info("  List of lists: %7.3f s", t_lists)
+    logging.info("  List of Spots: %7.3f s", t_spots)
+    logging.info("  SpotStore:     %7.3f s", t_store)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(main())
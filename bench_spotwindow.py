@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+#
+# Benchmark the live processing window, old spot list against SpotWindow
+#
+# Simulates polling cycles two minutes apart. Every cycle brings new spots,
+# most from the last few minutes, some uploaded late by up to the window age
+# and a few older than the window, on two bands. The old sequence concatenates, sorts,
+# deduplicates and time trims the whole list each cycle, SpotWindow adds the
+# new spots and expires old minutes. Checks that both give the same spots
+# after every cycle.
+#
+# Usage: bench_spotwindow.py [cycles] [spots per cycle]
+#
+
+import datetime
+import logging
+import random
+import sys
+import time
+
+from spot import Spot, epoch_minute, minutes_ago
+from spotwindow import SpotWindow
+
+
+#
+# deduplicate() from webscrape.py, keeps the last of spots with the same time,
+# call and band in a sorted list
+#
+def deduplicate(spotlist):
+    rc = 0
+    rc_max = len(spotlist) - 1
+    if rc_max > 1:
+        while rc < rc_max:
+            if (spotlist[rc].time == spotlist[rc + 1].time and spotlist[rc].call == spotlist[rc + 1].call and
+                    spotlist[rc].freq // 1000000 == spotlist[rc + 1].freq // 1000000):
+                del spotlist[rc]
+                rc_max -= 1
+            else:
+                rc += 1
+    return spotlist
+
+
+#
+# The old timetrim() with the time given
+#
+def timetrim(spots, m, now):
+    time_last = minutes_ago(m, now)
+    splitspotc = 0
+    for i, r in enumerate(spots):
+        if r.time < time_last:
+            splitspotc = i + 1
+    return spots[splitspotc:]
+
+
+def make_spots(now_m, nrspots):
+    calls = ["DL%dABC" % i for i in range(50)] + ["Q%d%dXYZ" % (i % 10, i % 10) for i in range(20)]
+    spots = []
+    for i in range(nrspots):
+        r = random.random()
+        if r < 0.8:
+            age = random.randint(0, 4)
+        elif r < 0.95:
+            # Late upload
+            age = random.randint(5, 59)
+        else:
+            # Older than the window
+            age = random.randint(60, 90)
+        freq = random.choice([14097000, 28126000]) + random.randint(0, 200)
+        spots.append(Spot(now_m - age, random.choice(calls), freq, random.randint(-30, 5), 0, 'JO62', 23,
+                          'G%dXYZ' % random.randint(0, 300), 'IO91', random.randint(100, 9000)))
+    return spots
+
+
+def main():
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nrspots = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    random.seed(1)
+    start = datetime.datetime(2020, 11, 4, 12, 0, 30)
+    batches = []
+    for c in range(cycles):
+        now = start + datetime.timedelta(minutes=2 * c)
+        batches.append((now, make_spots(epoch_minute(now), nrspots)))
+
+    t_old = 0.0
+    t_new = 0.0
+    same = True
+    spots = []
+    window = SpotWindow(max_age=60)
+    for now, newspots in batches:
+        tstart = time.time()
+        spots = spots + newspots
+        spots.sort()
+        spots = deduplicate(spots)
+        spots = timetrim(spots, 60, now)
+        t_old += time.time() - tstart
+
+        tstart = time.time()
+        window.update(newspots, now)
+        window.expire(now)
+        wspots = list(window)
+        t_new += time.time() - tstart
+
+        if wspots != spots:
+            same = False
+
+    logging.info("Cycles: %d, Spots per cycle: %d, Window: %d spots, Same: %s", cycles, nrspots, len(spots), same)
+    logging.info("  Sort + deduplicate + timetrim: %7.3f s", t_old)
+    logging.info("  SpotWindow:                    %7.3f s", t_new)
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,165 @@
+#
+# Random access index for gzipped wsprnet archives
+#
+# A monthly archive is a few GB of csv when uncompressed, and normally has to
+# be decompressed from the start to get to any spot. build() decompresses it
+# once and records a checkpoint every spacing bytes, with the decompressor
+# state needed to start there and the time of the first spot after it. This
+# is saved next to the archive, wsprspots-2020-11.csv.gz.idx. lines() then
+# only decompresses from the checkpoint before a time range to the one after.
+#
+# The archives are in upload order, so spot times are nearly but not exactly
+# increasing. The range is widened by slack minutes on both sides, spots
+# uploaded later than that after their time can be missed.
+#
+# Needs the indexed_gzip module, without it all files are read from the start.
+#
+
+import calendar
+import gzip
+import io
+import logging
+import os
+import pickle
+import time
+import zlib
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+spacing = 8 * 1024 * 1024   # Bytes of uncompressed data between checkpoints
+slack = 60                  # Minutes
+version = 1
+
+
+def sidecar(gzfile):
+    return gzfile + '.idx'
+
+
+#
+# Build index of gzfile and save it. Returns True if saved
+#
+def build(gzfile, spacing=spacing):
+    if indexed_gzip is None:
+        logging.info("gzindex.build() indexed_gzip is not installed, can't index %s", gzfile)
+        return False
+
+    logging.info("gzindex.build() Indexing %s", gzfile)
+    tstart = time.time()
+
+    with indexed_gzip.IndexedGzipFile(gzfile, spacing=spacing) as f:
+        f.build_full_index()
+
+        # Time of the first whole line after each checkpoint
+        points = []
+        for offset, cmp_offset in f.seek_points():
+            f.seek(offset)
+            if offset:
+                f.readline()
+            line = f.readline()
+            try:
+                points.append((offset, int(line.split(b',', 2)[1])))
+            except (IndexError, ValueError):
+                # Last checkpoint can be at the end of the file
+                pass
+
+        buf = io.BytesIO()
+        f.export_index(fileobj=buf)
+
+    index = {'version': version, 'size': os.path.getsize(gzfile), 'spacing': spacing,
+             'points': points, 'index': zlib.compress(buf.getvalue())}
+
+    filename = sidecar(gzfile)
+    tmp = filename + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except OSError as e:
+        logging.info("gzindex.build() Error writing %s: %s", filename, e)
+        return False
+
+    logging.info("gzindex.build() %d checkpoints in %.1f s, saved to %s", len(points), time.time() - tstart, filename)
+    return True
+
+
+#
+# Load index of gzfile. Returns None if there is none, or it is for another
+# version of the file
+#
+def load(gzfile):
+    if indexed_gzip is None:
+        return None
+
+    try:
+        with open(sidecar(gzfile), 'rb') as f:
+            index = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.info("gzindex.load() Error reading %s: %s", sidecar(gzfile), e)
+        return None
+
+    if index.get('version') != version or index.get('size') != os.path.getsize(gzfile):
+        logging.info("gzindex.load() Index %s is out of date, rebuild it", sidecar(gzfile))
+        return None
+
+    return index
+
+
+#
+# Uncompressed offsets to read to get the spots between since and until,
+# end None is to the end of the file
+#
+def span(index, since=None, until=None):
+    points = index['points']
+    start = 0
+    end = None
+
+    if since:
+        t = calendar.timegm(since.timetuple()) - slack * 60
+        for i, (offset, first) in enumerate(points):
+            if first < t:
+                start = offset
+            else:
+                break
+
+    if until:
+        t = calendar.timegm(until.timetuple()) + slack * 60
+        for offset, first in points:
+            if offset > start and first > t:
+                end = offset
+                break
+
+    return start, end
+
+
+#
+# Text lines of gzfile, only the part with the spots between since and until
+# if there is an index
+#
+def lines(gzfile, since=None, until=None):
+    index = load(gzfile) if since or until else None
+    if not index:
+        with gzip.open(gzfile, "rt") as f:
+            yield from f
+        return
+
+    start, end = span(index, since, until)
+    logging.info("gzindex.lines() Reading %s from %d to %s", gzfile, start, end if end is not None else "end")
+
+    with indexed_gzip.IndexedGzipFile(gzfile, spacing=index['spacing']) as f:
+        f.import_index(fileobj=io.BytesIO(zlib.decompress(index['index'])))
+        f.seek(start)
+        if start:
+            # Partial line before the first whole one
+            f.readline()
+
+        pos = f.tell()
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            yield line.decode('utf-8', 'replace')
@@ -0,0 +1,149 @@
+#
+# Shared HTTP client for wsprnet.org fetches and habhub uploads
+#
+# One requests session per host, so connections are kept alive and reused
+# from a pool. gzip/deflate is asked for and decoded by requests. Every
+# request has connect and read timeouts, and streamed bodies a total time
+# limit, so a stuck server can't hang the polling loop. GETs can be made
+# conditional on the ETag/Last-Modified of the last response for the same URL
+# that the caller has remembered, the caller gets a 304 response if nothing
+# changed. Request latency is kept as a histogram per host, for streamed
+# responses up to when the body has been read and the response closed.
+#
+
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+connect_timeout = 10    # Seconds
+read_timeout = 30       # Seconds between bytes received
+total_timeout = 120     # Seconds for a whole streamed body
+
+# Upper bounds in seconds of latency histogram buckets, last bucket is everything above
+buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+_sessions = {}          # host -> requests.Session
+_validators = {}        # url -> (etag, last modified)
+_latency = {}           # host -> list of counts per bucket
+_lock = threading.Lock()
+
+
+#
+# Session for host, created on first use
+#
+def session(host):
+    with _lock:
+        s = _sessions.get(host)
+        if s is None:
+            s = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8)
+            s.mount('http://', adapter)
+            s.mount('https://', adapter)
+            s.headers.update({'Accept-Encoding': 'gzip, deflate', 'User-Agent': 'hab-wspr'})
+            _sessions[host] = s
+        return s
+
+
+#
+# Make a request. Raises requests.exceptions.RequestException on errors and
+# timeouts like requests does.
+#
+def request(method, url, conditional=False, **kwargs):
+    host = urllib.parse.urlsplit(url).netloc
+    headers = dict(kwargs.pop('headers', None) or {})
+
+    if conditional:
+        etag, modified = _validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+
+    kwargs.setdefault('timeout', (connect_timeout, read_timeout))
+
+    tstart = time.time()
+    try:
+        resp = session(host).request(method, url, headers=headers, **kwargs)
+    except Exception:
+        _record(host, time.time() - tstart)
+        raise
+
+    if kwargs.get('stream'):
+        # Only the headers are in, count the time until the body is read and closed
+        _record_on_close(resp, host, tstart)
+    else:
+        _record(host, time.time() - tstart)
+
+    return resp
+
+
+#
+# Record the latency of a streamed response once, when it is closed
+#
+def _record_on_close(resp, host, tstart):
+    close = resp.close
+
+    def record_close():
+        if resp.close is record_close:
+            resp.close = close
+            _record(host, time.time() - tstart)
+        close()
+
+    resp.close = record_close
+
+
+#
+# Remember the ETag/Last-Modified of resp for conditional GETs of url. Call it
+# only when the whole body has been read and used, otherwise the next GET
+# would get a 304 for a page that was never processed
+#
+def remember(url, resp):
+    if resp.status_code == 200:
+        etag = resp.headers.get('ETag')
+        modified = resp.headers.get('Last-Modified')
+        if etag or modified:
+            _validators[url] = (etag, modified)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+#
+# Iterate over a streamed body, giving up after timeout seconds in total
+#
+def iter_body(resp, chunk_size=65536, timeout=None):
+    deadline = time.time() + (timeout or total_timeout)
+    for chunk in resp.iter_content(chunk_size):
+        yield chunk
+        if time.time() > deadline:
+            resp.close()
+            raise requests.exceptions.Timeout("Body of %s not received in time" % resp.url)
+
+
+def _record(host, latency):
+    i = 0
+    while i < len(buckets) and latency > buckets[i]:
+        i += 1
+    with _lock:
+        counts = _latency.setdefault(host, [0] * (len(buckets) + 1))
+        counts[i] += 1
+
+
+#
+# Latency histograms, like "wsprnet.org: <0.1s:0 <0.25s:3 ... >30s:0"
+#
+def stats():
+    s = []
+    with _lock:
+        for host, counts in _latency.items():
+            h = ["<%gs:%d" % (b, c) for b, c in zip(buckets, counts)] + [">%gs:%d" % (buckets[-1], counts[-1])]
+            s.append("%s: %s" % (host, " ".join(h)))
+    return " | ".join(s)
@@ -0,0 +1,193 @@
+#
+# Streaming pipeline for csv and archive mode
+#
+# readcsv() and readgzfiles() load all spots before anything is processed, so
+# memory grows with the input. Here spots flow one at a time through a chain
+# of generators:
+#
+#   parse -> filter -> window -> merge -> dedupe -> transmissions -> pair -> decode
+#
+# Parsing is iter_csv() or iter_gz(), one per file, and decode_pair() queues
+# the uploads of new sentences. Only spots still waiting for something are
+# held: the window of slack minutes per file that puts the spots in order, the
+# reports of the current minute, and per balloon the position transmissions of
+# the last 8 minutes with the telemetry after them. Memory stays the same
+# however large the input is.
+#
+# Each file has to be nearly in time order, like the archives that are in
+# upload order. Spots more than slack minutes late are dropped.
+#
+
+import collections
+import heapq
+import logging
+
+from spot import is_telemetry_call
+from telemetry import aggregate_spots, telemetry_channel, decode_pair, expire_pairs
+
+slack = 60      # Minutes
+
+
+#
+# Balloon spots and the telemetry spots on the channel and band of a balloon
+#
+def filter_spots(spots, balloons):
+    calls = set(b[1] for b in balloons)
+    channels = set((b[3], b[2]) for b in balloons)
+
+    for row in spots:
+        if row.call in calls:
+            yield row
+        elif is_telemetry_call(row.call) and (telemetry_channel(row.call), row.freq // 1000000) in channels:
+            yield row
+
+
+#
+# Spots in sorted order, the same as the sorted list from readgzfiles(). A
+# spot is held until one more than slack minutes newer has been seen
+#
+def window(spots, slack=slack):
+    heap = []
+    latest = None
+    released = None
+    late = 0
+
+    for row in spots:
+        if released is not None and row.time < released:
+            late += 1
+            continue
+
+        heapq.heappush(heap, row)
+        if latest is None or row.time > latest:
+            latest = row.time
+
+        while heap[0].time < latest - slack:
+            released = heap[0].time
+            yield heapq.heappop(heap)
+
+    while heap:
+        yield heapq.heappop(heap)
+
+    if late:
+        logging.info("pipeline.window() Dropped %d spots more than %d minutes late", late, slack)
+
+
+#
+# Drop spots seen before. Spots come in time order, so only the spots of the
+# current minute are remembered
+#
+def dedupe(spots):
+    seen = set()
+    minute = None
+    dups = 0
+
+    for row in spots:
+        if row.time != minute:
+            seen.clear()
+            minute = row.time
+        if row in seen:
+            dups += 1
+            continue
+        seen.add(row)
+        yield row
+
+    if dups:
+        logging.info("pipeline.dedupe() Dropped %d duplicate spots", dups)
+
+
+#
+# Group the reports of each minute into Transmissions, see aggregate_spots()
+#
+def transmissions(spots):
+    minute = None
+    reports = []
+
+    for row in spots:
+        if row.time != minute:
+            yield from aggregate_spots(reports)
+            reports = []
+            minute = row.time
+        reports.append(row)
+
+    yield from aggregate_spots(reports)
+
+
+#
+# Pair position transmissions with the telemetry transmissions 0 < t <= 8 min
+# after them, like pair_telemetry(). Yields (balloon, position, telemetry) once
+# all telemetry of a position has come, for pairs with telemetry
+#
+def pair(records, balloons):
+    # Per balloon, position transmissions waiting for telemetry, telemetry and
+    # the time of the last position
+    waiting = [collections.deque() for b in balloons]
+    telem = [collections.deque() for b in balloons]
+    last = [None for b in balloons]
+
+    def ready(now):
+        for i, b in enumerate(balloons):
+            while waiting[i] and (now is None or waiting[i][0].time + 8 < now):
+                row = waiting[i].popleft()
+                b_telem = [r for r in telem[i] if row.time < r.time <= row.time + 8]
+                if b_telem:
+                    yield b, row, b_telem
+
+            # Telemetry no waiting or later position can be paired with
+            first = waiting[i][0].time if waiting[i] else now
+            while telem[i] and (first is None or telem[i][0].time <= first):
+                telem[i].popleft()
+
+    minute = None
+    for row in records:
+        if row.time != minute:
+            yield from ready(row.time)
+            minute = row.time
+
+        call = row.call
+        if is_telemetry_call(call):
+            channel = telemetry_channel(call)
+            band = row.freq // 1000000
+            slot = row.time % 10 // 2
+
+        for i, b in enumerate(balloons):
+            if call == b[1]:
+                # Only check new uniq times
+                if row.time != last[i]:
+                    waiting[i].append(row)
+                    last[i] = row.time
+            elif is_telemetry_call(call) and channel == b[3] and band == b[2] and (b[4] >= 9 or slot == b[4]):
+                telem[i].append(row)
+
+    yield from ready(None)
+
+
+#
+# Decode the pairs and queue uploads of new sentences, waiting for room in the
+# upload queues as there is no next cycle. Decoded pairs older than the pairs
+# still to come are forgotten as the stream moves on
+#
+def decode(pairs, habhub_callsign, push_habhub, push_aprs):
+    nrpairs = 0
+    minute = None
+
+    for b, row, b_telem in pairs:
+        nrpairs += 1
+        if row.time != minute:
+            expire_pairs(row.time - 10)
+            minute = row.time
+        decode_pair(b, row, b_telem, habhub_callsign, push_habhub, push_aprs, block=True)
+
+    return nrpairs
+
+
+#
+# Run spots from readers through the whole pipeline, one reader per file. The
+# files are put in order each on their own and then merged, so they can
+# overlap in time
+#
+def run(sources, balloons, habhub_callsign, push_habhub, push_aprs):
+    spots = heapq.merge(*[window(filter_spots(s, balloons)) for s in sources])
+    records = transmissions(dedupe(spots))
+    nrpairs = decode(pair(records, balloons), habhub_callsign, push_habhub, push_aprs)
+    logging.info("pipeline.run() Decoded %d pairs", nrpairs)
+    return nrpairs
@@ -0,0 +1,63 @@
+#
+# Snapshot of the live state for a warm start after a restart
+#
+# The spot cache, the processing window, the fetcher watermarks and the
+# decoded pairs are pickled to one gzipped file every polling cycle. The file
+# is written under a temporary name and renamed over the old one, so a crash
+# while writing leaves the previous snapshot. At startup a recent snapshot is
+# loaded, and only the spots arrived since it are fetched.
+#
+
+import gzip
+import logging
+import os
+import pickle
+import time
+
+version = 4
+
+
+#
+# Write state atomically to filename. Returns True if written
+#
+def save(filename, state):
+    tmp = filename + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gz:
+                pickle.dump({'version': version, 'time': time.time(), 'state': state}, gz, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except (OSError, pickle.PicklingError) as e:
+        logging.info("snapshot.save() Error writing %s: %s", filename, e)
+        return False
+
+    return True
+
+
+#
+# Load state from filename. Returns None if there is no usable snapshot
+# younger than max_age minutes
+#
+def load(filename, max_age):
+    try:
+        with gzip.open(filename, 'rb') as f:
+            snap = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.info("snapshot.load() Error reading %s: %s", filename, e)
+        return None
+
+    if not isinstance(snap, dict) or snap.get('version') != version:
+        logging.info("snapshot.load() Unknown snapshot version in %s, ignoring", filename)
+        return None
+
+    age = time.time() - snap['time']
+    if age > max_age * 60:
+        logging.info("snapshot.load() Snapshot %s is %d minutes old, ignoring", filename, age / 60)
+        return None
+
+    logging.info("snapshot.load() Loaded snapshot %s, %d s old", filename, age)
+    return snap['state']
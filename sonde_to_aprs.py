@@ -21,6 +21,7 @@
 import logging
 import configparser
 import time, datetime, urllib3, sys
+import threading
 from socket import *
 
 # APRS-IS login info
@@ -32,11 +33,184 @@ config = configparser.ConfigParser()
 config.read('balloon.ini')
 aprsUser = config['main']['aprsUser']
 aprsPass = config['main']['aprsPass']
+serverHost = config.get('main', 'aprsServer', fallback=serverHost)
+serverPort = config.getint('main', 'aprsPort', fallback=serverPort)
+
+# Max packets per second sent to APRS-IS
+aprsRate = config.getfloat('main', 'aprsRate', fallback=1.0)
 
 # APRS packet Settings
 # This is the callsign the object comes from. Doesn't necessarily have to be the same as your APRS-IS login. 
 callsign = config['main']['aprsCallsign']
 
+#
+# Long lived APRS-IS session
+#
+# Logs in once and sends any number of packets over the same connection.
+# Lines from the server are read (and mostly ignored) by a reader thread, a
+# keepalive comment is sent when the session has been idle. If the
+# connection is lost it is opened again on the next send. Packets are rate
+# limited to rate packets per second.
+#
+# send_lock lets one sender at a time wait for the rate limit, connect and
+# send. lock only guards the socket and counters for a moment, so a dead
+# server doesn't block stats() or the keepalive thread.
+#
+class APRSISClient:
+
+	def __init__(self, host=serverHost, port=serverPort, user=aprsUser, passcode=aprsPass, rate=aprsRate, keepalive=60, timeout=30):
+		self.host = host
+		self.port = port
+		self.user = user
+		self.passcode = passcode
+		self.interval = 1.0 / rate if rate > 0 else 0
+		self.keepalive = keepalive
+		self.timeout = timeout
+
+		self.sock = None
+		self.lock = threading.Lock()
+		self.send_lock = threading.RLock()
+		self.last_send = 0
+		self.running = True
+
+		# Counters
+		self.packets = 0
+		self.connects = 0
+		self.errors = 0
+		self.first_packet = None
+		self.last_packet = None
+
+		threading.Thread(target=self._keepalive, name="aprsis-keepalive", daemon=True).start()
+
+	# Connect and login, if not already connected. Returns the socket
+	def connect(self):
+		with self.send_lock:
+			with self.lock:
+				if self.sock:
+					return self.sock
+
+			# Server sends a comment line at least every 20 s, no data for long means a dead connection
+			sock = create_connection((self.host, self.port), self.timeout)
+			sock.settimeout(max(self.timeout, self.keepalive * 2))
+			tosend = "user %s pass %s vers VK5QI-Python 0.01\n" % (self.user, self.passcode)
+			logging.info("APRSISClient.connect() %s:%d %s", self.host, self.port, tosend.strip())
+			try:
+				sock.sendall(tosend.encode('utf-8'))
+			except OSError:
+				sock.close()
+				raise
+
+			with self.lock:
+				self.sock = sock
+				self.connects += 1
+				self.last_send = time.time()
+			threading.Thread(target=self._reader, args=(sock,), name="aprsis-reader", daemon=True).start()
+			return sock
+
+	# Drop connection, sock is the one that failed
+	def disconnect(self, sock=None):
+		with self.lock:
+			if self.sock is None or (sock is not None and sock is not self.sock):
+				return
+			sock = self.sock
+			self.sock = None
+		try:
+			sock.shutdown(SHUT_RDWR)
+		except OSError:
+			pass
+		sock.close()
+
+	def close(self):
+		self.running = False
+		self.disconnect()
+
+	# Send one line, connecting first if needed. Returns True if sent.
+	def send(self, line):
+		with self.send_lock:
+			with self.lock:
+				wait = self.last_send + self.interval - time.time()
+			if wait > 0:
+				time.sleep(wait)
+
+			for attempts in range(3):
+				sock = None
+				try:
+					sock = self.connect()
+					sock.sendall((line + "\n").encode('utf-8'))
+					with self.lock:
+						self.last_send = time.time()
+					return True
+				except OSError as err:
+					logging.info("APRSISClient.send() Error: %s", err)
+					with self.lock:
+						self.errors += 1
+					self.disconnect(sock)
+		return False
+
+	# Send one packet. Returns True if sent.
+	def send_packet(self, packet):
+		if not self.send(packet):
+			return False
+
+		with self.lock:
+			self.packets += 1
+			self.last_packet = time.time()
+			if self.first_packet is None:
+				self.first_packet = self.last_packet
+		return True
+
+	# Read and log lines from server until the connection is closed
+	def _reader(self, sock):
+		f = sock.makefile('r', encoding='utf-8', errors='replace')
+		try:
+			for line in f:
+				line = line.strip()
+				if line.startswith('#'):
+					logging.debug("APRSISClient server: %s", line)
+				else:
+					logging.info("APRSISClient server: %s", line)
+		except (OSError, ValueError):
+			pass
+		logging.info("APRSISClient._reader() Connection closed")
+		self.disconnect(sock)
+
+	def _keepalive(self):
+		while self.running:
+			time.sleep(min(self.keepalive, 10))
+			with self.lock:
+				idle = self.sock is not None and time.time() - self.last_send > self.keepalive
+			# Skip it if a packet is being sent anyway
+			if idle and self.send_lock.acquire(blocking=False):
+				try:
+					self.send("#keepalive")
+				finally:
+					self.send_lock.release()
+
+	def stats(self):
+		with self.lock:
+			pps = 0.0
+			if self.packets > 1:
+				pps = (self.packets - 1) / max(self.last_packet - self.first_packet, 0.001)
+			return "Packets: %d Rate: %.2f p/s Connects: %d Errors: %d" % (self.packets, pps, self.connects, self.errors)
+
+
+aprs_client = None
+
+#
+# Shared APRS-IS session, created on first use
+#
+def get_aprs_client():
+	global aprs_client
+	if aprs_client is None:
+		aprs_client = APRSISClient()
+	return aprs_client
+
+def aprs_stats():
+	if aprs_client is None:
+		return "Not connected"
+	return aprs_client.stats()
+
+
 # Get KML from SondeMonitor and parse into a Python dictionary
 def get_sonde():
 	sonde_data = {}
@@ -46,7 +220,7 @@ def get_sonde():
 	sonde_data["id"] = str(sys.argv[1])
 	return sonde_data
 
-# Push a Radiosonde data packet to APRS as an object.
+# Push a Radiosonde data packet to APRS as an object. Returns True if sent.
 def push_balloon_to_aprs(sonde_data, telestr):
 	# Pad or limit the sonde ID to 9 characters.
 	object_name = sonde_data["id"]
@@ -82,32 +256,9 @@ def push_balloon_to_aprs(sonde_data, telestr):
 	out_str = ";%s*111111z%s/%sO000/000/A=%06d Balloon %s" % (object_name,lat_str,lon_str,alt,telestr)
 	logging.info("push_balloon_to_aprs() sending: %s", out_str)
 
-	# Connect to an APRS-IS server, login, then push our object position in.
-	for attempts in range(3):
-		try:	
-			# create socket & connect to server
-			sSock = socket(AF_INET, SOCK_STREAM)
-			sSock.connect((serverHost, serverPort))
-			logging.info("sSock.connected")
-			# logon
-			#sSock.send(b'user %s pass %s vers VK5QI-Python 0.01\n' % (aprsUser.encode('utf-8'), aprsPass.encode('utf-8')) )
-			tosend = "user %s pass %s vers VK5QI-Python 0.01\n" % (aprsUser,aprsPass)
-			logging.info(tosend)
-			sSock.send(tosend.encode('utf-8'))
-			# send packet
-			#sSock.send(b'%s>APRS:%s\n' % (callsign.encode('utf-8'), out_str.encode('utf-8')) )
-			tosend = "%s>APRS:%s\n" % (callsign,out_str)
-			logging.info(tosend)
-			sSock.send(tosend.encode('utf-8'))
-			# close socket
-			sSock.shutdown(0)
-			sSock.close()
-			time.sleep(10)
-			break
-		except (sSock.error, sSock.timeout, sSock.gaierror) as err:
-			logging.info("Error: Unable to connect to APRS-IS server, packet dropped! %s", err) 
-		finally:
-			sSock.close()
+	# Send packet over the shared APRS-IS session
+	tosend = "%s>APRS:%s" % (callsign,out_str)
+	return get_aprs_client().send_packet(tosend)
 
 
 # VE3OCL-11:PARM.Speed,Temp,Vbat,GPS,Sats
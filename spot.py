@@ -0,0 +1,91 @@
+#
+# Spot record used all through the pipeline
+#
+# A spot is an immutable named tuple with the fields in the same order as the
+# old spot lists, so spot[1] is still the call. Time is whole minutes since
+# 1970-01-01 UTC and frequency whole Hz, so sorting and window checks are
+# integer compares. Calls, locators and reporters are interned, the many spots
+# of one station share one string.
+#
+# Example: 2018-05-28 05:50,OM1AI,7.040137,-15,0,JN88,+23,DA5UDI,JO30qj,724
+#   Spot(time=25458110, call='OM1AI', freq=7040137, snr=-15, drift=0, loc='JN88',
+#        power=23, reporter='DA5UDI', reporter_loc='JO30qj', distance=724)
+#
+
+import collections
+import datetime
+import functools
+import math
+import sys
+
+Spot = collections.namedtuple('Spot', ['time', 'call', 'freq', 'snr', 'drift', 'loc', 'power',
+                                       'reporter', 'reporter_loc', 'distance'])
+
+# One transmission with all its reports, see telemetry.aggregate_spots(). reporters
+# is a tuple of (reporter, reporter_loc, snr, drift, distance)
+Transmission = collections.namedtuple('Transmission', Spot._fields + ('reporters',))
+
+epoch = datetime.datetime(1970, 1, 1)
+
+
+#
+# Check if call is a telemetry packet. Same as re.match('(^0|^Q).[0-9].*', call)
+#
+def is_telemetry_call(call):
+    return len(call) > 2 and call[0] in '0Q' and call[2] in '0123456789'
+
+
+#
+# Spot with interned strings
+#
+def make_spot(time, call, freq, snr, drift, loc, power, reporter, reporter_loc, distance):
+    intern = sys.intern
+    return Spot(time, intern(call), freq, snr, drift, intern(loc), power, intern(reporter), intern(reporter_loc), distance)
+
+
+#
+# UTC datetime to minutes since epoch, and back
+#
+def epoch_minute(dt):
+    return int((dt - epoch).total_seconds()) // 60
+
+
+def minute_datetime(m):
+    return epoch + datetime.timedelta(minutes=m)
+
+
+#
+# Minute as text 'YYYY-MM-DD HH:MM', as in wsprnet pages, csv files and the
+# database, and back. Thousands of spots share each minute, so the last few
+# days of minutes are remembered instead of parsed or formatted again
+#
+@functools.lru_cache(maxsize=8192)
+def parse_minute(s):
+    return epoch_minute(datetime.datetime.strptime(s, '%Y-%m-%d %H:%M'))
+
+
+@functools.lru_cache(maxsize=8192)
+def format_minute(m):
+    return minute_datetime(m).strftime('%Y-%m-%d %H:%M')
+
+
+#
+# First minute that is not older than m minutes before now. Spots with time
+# before it are older than m minutes
+#
+def minutes_ago(m, now=None):
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return math.ceil((now - epoch).total_seconds() / 60) - m
+
+
+#
+# Frequency in MHz as text, like '14.097123', to Hz and back
+#
+def parse_freq(s):
+    mhz, dot, decimals = s.strip().partition('.')
+    return int(mhz or 0) * 1000000 + int((decimals + '000000')[:6])
+
+
+def format_freq(hz):
+    return '%d.%06d' % divmod(hz, 1000000)
@@ -0,0 +1,89 @@
+#
+# Cache of spots already seen from wsprnet.org
+#
+# Spots are kept in a dict keyed by the full spot, so checking a fetched
+# spot against the cache is a single hash lookup. A heap ordered by spot
+# time gives the oldest entry for eviction, both when the cache grows past
+# max_size and when spots fall outside the max_age window.
+#
+
+import heapq
+import logging
+
+from spot import minutes_ago
+
+
+class SpotCache:
+
+    def __init__(self, max_age=120, max_size=10000):
+        self.max_age = max_age          # Minutes
+        self.max_size = max_size
+        self.spots = {}                 # key -> spot time in minutes
+        self.order = []                 # heap of (spot time, seqnr, key)
+        self.seqnr = 0
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.spots)
+
+    def __contains__(self, row):
+        return self.key(row) in self.spots
+
+    #
+    # Hashable key of a spot. Two spots are the same if all fields match
+    #
+    @staticmethod
+    def key(row):
+        return row
+
+    #
+    # Add spot to cache. Returns True if the spot is new, False if already seen
+    #
+    def add(self, row):
+        k = self.key(row)
+        if k in self.spots:
+            self.hits += 1
+            return False
+
+        self.misses += 1
+        self.spots[k] = row.time
+        self.seqnr += 1
+        heapq.heappush(self.order, (row.time, self.seqnr, k))
+
+        if len(self.spots) > self.max_size:
+            self.evict()
+
+        return True
+
+    #
+    # Add a list of spots, return the ones not seen before in the same order
+    #
+    def update(self, rows):
+        return [row for row in rows if self.add(row)]
+
+    #
+    # Remove the oldest spot from the cache
+    #
+    def evict(self):
+        t, seqnr, k = heapq.heappop(self.order)
+        del self.spots[k]
+        self.evictions += 1
+
+    #
+    # Remove spots older than max_age minutes
+    #
+    def expire(self, now=None):
+        time_last = minutes_ago(self.max_age, now)
+
+        pre = len(self.spots)
+        while self.order and self.order[0][0] < time_last:
+            self.evict()
+
+        logging.info("SpotCache.expire() In: %d Out: %d", pre, len(self.spots))
+
+    def stats(self):
+        return "Cache: %5d Hits: %5d Misses: %5d Evictions: %5d" % (len(self.spots), self.hits, self.misses, self.evictions)
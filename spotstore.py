@@ -0,0 +1,207 @@
+#
+# Columnar store of spots for archive processing
+#
+# A month of archive spots as a list of Spot tuples costs a few hundred bytes
+# per spot. SpotStore keeps each field as one NumPy array instead, numbers as
+# small ints and calls, locators and reporters as codes into a table of the
+# distinct strings. Filtering on calls, band and time range is done on whole
+# columns, and grouping reports into transmissions is a sort of the key
+# columns. Spots come out as Spot or Transmission records where needed.
+#
+# Needs numpy.
+#
+
+import array
+
+import numpy as np
+
+from spot import Spot, Transmission, is_telemetry_call
+
+# Numeric fields, array.array typecode used while building and numpy dtype
+numeric = {'time': ('l', np.int32), 'freq': ('q', np.int64), 'snr': ('l', np.int16), 'drift': ('l', np.int16),
+           'power': ('l', np.int16), 'distance': ('l', np.int32)}
+
+# Text fields, stored as codes into a table of distinct values
+categorical = ('call', 'loc', 'reporter', 'reporter_loc')
+
+
+class SpotStore:
+
+    def __init__(self, columns, categories):
+        self.columns = columns          # field -> array, codes for categorical fields
+        self.categories = categories    # categorical field -> list of values
+
+    def __len__(self):
+        return len(self.columns['time'])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    #
+    # Build from Spots, the spots can be a generator so no list is needed
+    #
+    @classmethod
+    def from_spots(cls, spots):
+        values = {f: array.array(numeric[f][0]) for f in numeric}
+        codes = {f: array.array('l') for f in categorical}
+        lookup = {f: {} for f in categorical}
+
+        for s in spots:
+            for f in numeric:
+                values[f].append(getattr(s, f))
+            for f in categorical:
+                v = getattr(s, f)
+                c = lookup[f].get(v)
+                if c is None:
+                    c = lookup[f][v] = len(lookup[f])
+                codes[f].append(c)
+
+        columns = {f: np.array(values[f], dtype=numeric[f][1]) for f in numeric}
+        columns.update({f: np.array(codes[f], dtype=np.uint32) for f in categorical})
+        categories = {f: list(lookup[f]) for f in categorical}
+        return cls(columns, categories)
+
+    #
+    # Join stores into one, merging the tables of strings
+    #
+    @classmethod
+    def concat(cls, stores):
+        stores = list(stores)
+        if not stores:
+            return cls.from_spots([])
+
+        columns = {f: np.concatenate([s.columns[f] for s in stores]) for f in numeric}
+        categories = {}
+        for f in categorical:
+            lookup = {}
+            parts = []
+            for s in stores:
+                remap = np.array([lookup.setdefault(v, len(lookup)) for v in s.categories[f]], dtype=np.uint32)
+                parts.append(remap[s.columns[f]] if len(remap) else s.columns[f])
+            columns[f] = np.concatenate(parts)
+            categories[f] = list(lookup)
+        return cls(columns, categories)
+
+    #
+    # Spots where mask is True, or at the positions in an index array
+    #
+    def take(self, index):
+        return SpotStore({f: c[index] for f, c in self.columns.items()}, self.categories)
+
+    #
+    # Mask of spots with a value of categorical field f for which match(value) is True
+    #
+    def match(self, f, match):
+        table = np.array([bool(match(v)) for v in self.categories[f]], dtype=bool)
+        if not len(table):
+            return np.zeros(len(self), dtype=bool)
+        return table[self.columns[f]]
+
+    #
+    # Select spots with a call in calls, or a telemetry call if telemetry is
+    # True, on one of bands (MHz) and between since and until (epoch minutes)
+    #
+    def select(self, calls=None, telemetry=False, bands=None, since=None, until=None):
+        mask = np.ones(len(self), dtype=bool)
+        if calls is not None or telemetry:
+            calls = set(calls or ())
+            mask &= self.match('call', lambda c: c in calls or (telemetry and is_telemetry_call(c)))
+        if bands is not None:
+            mask &= np.isin(self.columns['freq'] // 1000000, list(bands))
+        if since is not None:
+            mask &= self.columns['time'] >= since
+        if until is not None:
+            mask &= self.columns['time'] <= until
+        return self.take(mask)
+
+    #
+    # Codes of categorical field f renumbered in sort order of the strings
+    #
+    def ranks(self, f):
+        table = self.categories[f]
+        rank = np.empty(len(table), dtype=np.uint32)
+        rank[sorted(range(len(table)), key=table.__getitem__)] = np.arange(len(table), dtype=np.uint32)
+        return rank[self.columns[f]] if len(table) else self.columns[f]
+
+    #
+    # Sorted in the same order as a sorted list of the Spots
+    #
+    def sort(self):
+        keys = []
+        for f in Spot._fields:
+            keys.append(self.ranks(f) if f in categorical else self.columns[f])
+        # lexsort sorts on the last key first
+        return self.take(np.lexsort(keys[::-1]))
+
+    def spot(self, i):
+        return Spot(*[self.categories[f][self.columns[f][i]] if f in categorical else int(self.columns[f][i])
+                      for f in Spot._fields])
+
+    #
+    # Columns as lists of values, in Spot field order
+    #
+    def lists(self):
+        fields = []
+        for f in Spot._fields:
+            if f in categorical:
+                table = self.categories[f]
+                fields.append([table[c] for c in self.columns[f].tolist()])
+            else:
+                fields.append(self.columns[f].tolist())
+        return fields
+
+    def __iter__(self):
+        return (Spot(*s) for s in zip(*self.lists()))
+
+    #
+    # Group reports into Transmissions, like telemetry.aggregate_spots()
+    #
+    # Reports are grouped on (time, call, locator, power, band) by sorting the
+    # key columns, each Transmission has the fields of the first report of its
+    # group and comes in order of that first report.
+    #
+    def transmissions(self):
+        n = len(self)
+        if n == 0:
+            return []
+
+        cols = self.columns
+        keys = [cols['time'], cols['call'], cols['loc'], cols['power'], cols['freq'] // 1000000]
+        order = np.lexsort([np.arange(n)] + keys[::-1])
+
+        change = np.zeros(n, dtype=bool)
+        change[0] = True
+        for k in keys:
+            ks = k[order]
+            change[1:] |= ks[1:] != ks[:-1]
+        starts = np.flatnonzero(change)
+        ends = np.append(starts[1:], n)
+
+        # Groups in order of their first report
+        firsts = order[starts]
+        groups = np.argsort(firsts, kind='stable')
+
+        fields = self.lists()
+        # (reporter, reporter_loc, snr, drift, distance) of every report
+        reports = list(zip(fields[7], fields[8], fields[3], fields[4], fields[9]))
+        order = order.tolist()
+        starts = starts.tolist()
+        ends = ends.tolist()
+
+        records = []
+        for g in groups.tolist():
+            idx = order[starts[g]:ends[g]]
+            records.append(Transmission(*[f[idx[0]] for f in fields], tuple(reports[i] for i in idx)))
+        return records
+
+    #
+    # Bytes used by the columns and the tables of strings
+    #
+    def nbytes(self):
+        size = sum(c.nbytes for c in self.columns.values())
+        for table in self.categories.values():
+            size += sum(len(v) + 49 for v in table)
+        return size
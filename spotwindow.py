@@ -0,0 +1,151 @@
+#
+# Window of recent spots passed to process_window()
+#
+# Spots are kept in one bucket per minute, in a deque ordered by minute, so
+# adding a spot is a dict insert into its bucket and expiring old spots pops
+# whole buckets off the left end. Within a bucket spots are deduplicated by
+# (time, call, band) on insert, keeping the same spot the old sort + deduplicate()
+# kept. Iterating gives the spots in time order, only buckets changed since
+# last iteration are sorted again. The minutes that got spots are remembered
+# until pop_changed(), so the spots can be processed a minute at a time.
+#
+
+import collections
+import datetime
+import logging
+
+from spot import minutes_ago
+
+
+class SpotWindow:
+
+    def __init__(self, max_age=60, max_ahead=10):
+        self.max_age = max_age          # Minutes
+        self.max_ahead = max_ahead      # Minutes a spot can be ahead of now
+        self.start = None               # Minute of first bucket
+        self.buckets = collections.deque()  # [(time, call, band) -> spot, sorted spots or None]
+        self.count = 0
+        self.changed = set()            # Minutes with spots added since pop_changed()
+
+        # Counters
+        self.added = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def __len__(self):
+        return self.count
+
+    #
+    # Add spot to window. Returns True if no spot with the same time and call was there
+    #
+    def add(self, row, now=None):
+        m = row.time
+
+        if m < minutes_ago(self.max_age, now) or m > minutes_ago(-self.max_ahead, now):
+            # Older than the window, or in the future from a receiver with its clock wrong
+            self.rejected += 1
+            return False
+
+        if self.start is None:
+            self.start = m
+        if m < self.start:
+            if not self.count:
+                # Empty window, move start back
+                self.buckets.clear()
+                self.start = m
+            else:
+                # Late spot, add buckets in front back to its minute
+                for i in range(self.start - m):
+                    self.buckets.appendleft([{}, []])
+                self.start = m
+
+        i = m - self.start
+        while len(self.buckets) <= i:
+            self.buckets.append([{}, []])
+
+        bucket = self.buckets[i]
+        # All bands come in one stream, a call can be on two bands in the same minute
+        k = (row.time, row.call, row.freq // 1000000)
+        old = bucket[0].get(k)
+        if old is not None:
+            self.duplicates += 1
+            # Keep the last one in sort order, like deduplicate() did
+            if row > old:
+                bucket[0][k] = row
+                bucket[1] = None
+                self.changed.add(m)
+            return False
+
+        bucket[0][k] = row
+        bucket[1] = None
+        self.changed.add(m)
+        self.count += 1
+        self.added += 1
+        return True
+
+    #
+    # Add a list of spots, return the number of new ones
+    #
+    def update(self, rows, now=None):
+        if now is None:
+            now = datetime.datetime.utcnow()
+        n = 0
+        for row in rows:
+            if self.add(row, now):
+                n += 1
+        return n
+
+    #
+    # Remove spots older than max_age minutes
+    #
+    def expire(self, now=None):
+        first = minutes_ago(self.max_age, now)
+
+        pre = self.count
+        while self.buckets and self.start < first:
+            bucket = self.buckets.popleft()
+            self.count -= len(bucket[0])
+            self.expired += len(bucket[0])
+            self.start += 1
+
+        if not self.buckets:
+            self.start = None
+
+        logging.info("SpotWindow.expire() In: %d Out: %d", pre, self.count)
+
+    def __iter__(self):
+        for bucket in self.buckets:
+            if bucket[1] is None:
+                bucket[1] = sorted(bucket[0].values())
+            yield from bucket[1]
+
+    #
+    # Sorted spots of minute m
+    #
+    def minute(self, m):
+        if self.start is None or not self.start <= m < self.start + len(self.buckets):
+            return []
+        bucket = self.buckets[m - self.start]
+        if bucket[1] is None:
+            bucket[1] = sorted(bucket[0].values())
+        return bucket[1]
+
+    #
+    # Minutes still in the window that got spots since the last call, in order
+    #
+    def pop_changed(self):
+        changed = sorted(m for m in self.changed if self.start is not None and m >= self.start)
+        self.changed = set()
+        return changed
+
+    #
+    # Mark all minutes as changed, to process the whole window again
+    #
+    def touch(self):
+        if self.start is not None:
+            self.changed.update(range(self.start, self.start + len(self.buckets)))
+
+    def stats(self):
+        return "Window: %5d Added: %5d Duplicates: %5d Rejected: %5d Expired: %5d" % (self.count, self.added, self.duplicates,
+                                                                                     self.rejected, self.expired)
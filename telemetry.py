@@ -1,24 +1,33 @@
 #!/usr/bin/python3.6
 
 from base64 import b64encode
+import bisect
+import calendar
 import configparser
+import contextlib
 import csv
 import datetime
 from datetime import datetime,timedelta
-import gzip
 import hashlib
-import httplib2
+import httpclient
 import logging
 import json
+import multiprocessing
 import re
 import requests
 import sqlite3
 import sys
+import threading
 import time
 
 from pprint import pformat
 
+import gzindex
 import maidenhead
+import uploader
+import wsprdb
+
+from spot import Spot, Transmission, is_telemetry_call, make_spot, parse_minute, minute_datetime, format_minute, minutes_ago, parse_freq
 
 from balloon import *
 from sonde_to_aprs import * 
@@ -53,31 +62,18 @@ def trim(spots):
 #
 def readnewspotsdb():
     spots = []
-    con = None
-    data = None
-    
-    try:
-        con = sqlite3.connect('wsprdb.db')
-        cur = con.cursor()
-        cur.execute('select * from newspots')
-        data = cur.fetchall()
 
+    try:
+        data = wsprdb.execute('select * from newspots')
         for row in data:
-#            logging.info(row)'
-            row[0] = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M')
-            spots.append(list(row))
-#            sys.exit(0)
-
-        if not data:
-            con.commit()
+            spots.append(make_spot(parse_minute(row[0]), row[1], int(round(float(row[2]) * 1000000)),
+                                   row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
     except sqlite3.Error as e:
         logging.info("readnewspotsdb() Database error: %s", e)
     except Exception as e:
         logging.info("readnewspotsdb() Exception in _query: %s", e)
-    finally:
-        if con:
-            con.close()
-    logging.info("Loaded spots: ", len(spots))
+
+    logging.info("Loaded spots: %d", len(spots))
     return spots
 
 
@@ -109,75 +105,117 @@ def readnewspotsdb():
 #
 # Read spots from a downloaded GZip file
 #
-def readgz(balloons, gzfile):
-    logging.info("Reading gz: %s", gzfile)
+# Only the callsign and time columns are looked at for most rows. Rows from a
+# balloon or with a telemetry call are parsed fully and reordered to the spot
+# format above.
+#
+# since/until limit the spots to a time range, compared on the raw unix time
+# before anything is converted. If the file is known to be sorted on time,
+# ordered=True stops reading at the first row past until.
+#
+# Returns a list of spots, or a SpotStore if store=True.
+#
+def readgz(balloons, gzfile, since=None, until=None, ordered=False, store=False):
+    spots = iter_gz(balloons, gzfile, since, until, ordered)
+    if store:
+        from spotstore import SpotStore
+        return SpotStore.from_spots(spots)
+    return list(spots)
+
+
+#
+# Generator of the spots read by readgz()
+#
+def iter_gz(balloons, gzfile, since=None, until=None, ordered=False):
+    logging.info("readgz() Reading gz: %s", gzfile)
 
     rows = 0
-    spots = []
-    calls = []
-    for b in balloons:
-        calls.append(b[1])
+    nrspots = 0
+    calls = set([b[1] for b in balloons])
+    tstart = time.time()
 
-    logging.info("readgz() Open gz")
-    with gzip.open(gzfile, "rt") as csvfile:
-        spotsreader = csv.reader(csvfile, delimiter=',', quotechar='|')
+    # Unix times in the archives are 10 digits, so they compare right as strings
+    since_ts = '%010d' % calendar.timegm(since.timetuple()) if since else None
+    until_ts = '%010d' % calendar.timegm(until.timetuple()) if until else None
 
-        logging.info("readgz() Process rows")
-        for row in spotsreader:
+    # Only the part of the file with the time range, if it has an index
+    with contextlib.closing(gzindex.lines(gzfile, since, until)) as csvfile:
+        for line in csvfile:
             rows += 1
-            #logging.info(row)
-            # Select correct fields in correct order
-            row = [row[1], row[6], row[5], row[4], row[9], row[7], row[8],row[2],row[3],row[10]]
-            #logging.info(row)
-
-            # logging.info(', '.join(row))
-            #print(".", end = '')
-            for c in calls:
-                if row[1] == c:
-                    logging.info("Found: %s %s", c, row) 
-                    # Remove extra 2 locator chars from 'home' transmissions
-                    #logging.info(row[5])
-                    if len(row[5]) == 6:
-                        #logging.info(row[5])
-                        row[5] = row[5][0:4]
-                        #logging.info(row[5]) 
-
-                    logging.info("Found Pre: %s, %s.", c, row)
-                    print(type(row[0]))
-                    if isinstance(row[0], str):
-                        print("String")
-                        row[0] = datetime.datetime.fromtimestamp(int(row[0]))
-                    else:
-                        print("Not String")
-                        row[0] = row[0]
-                    row[3] = int(row[3])
-                    row[4] = int(row[4])
-
-                    # Strip "+" from dB
-                    #row[6] = int(row[6].replace('+',''))
-                    row[9] = int(row[9])
-                    logging.info("Found Post: %s, %s.", c, row)
-
-                    spots.append(row)
-
-            if re.match('(^0|^Q).[0-9].*', row[1]):
-                logging.info("Found Telem Pre: %s", row)
-                row[0] = datetime.datetime.fromtimestamp(int(row[0]))
-                
-                row[3] = int(row[3])
-                row[4] = int(row[4])
-                        
-                # Strip "+" from dB
-                row[6] = int(row[6].replace('+',''))
-                row[9] = int(row[9])
-
-                #logging.info("Found Telem Post:", row) 
-                spots.append(row)
-                # sys.exit(0)
-
-        logging.info("Total rows: %d, Nr-calls+telem: %d.", rows, len(spots))
-        csvfile.close()
 
+            # Call sign is the 7th column, don't split more than needed to get it
+            fields = line.split(',', 7)
+            if len(fields) < 8:
+                continue
+
+            if until_ts and fields[1] > until_ts:
+                if ordered:
+                    logging.info("readgz() Passed %s, stop reading", until)
+                    break
+                continue
+
+            call = fields[6]
+
+            if call in calls:
+                telem = False
+            elif is_telemetry_call(call):
+                telem = True
+            else:
+                continue
+
+            if since_ts and fields[1] < since_ts:
+                continue
+
+            row = next(csv.reader([line], delimiter=',', quotechar='|'))
+            loc = row[7]
+            if not telem:
+                # Remove extra 2 locator chars from 'home' transmissions
+                if len(loc) == 6:
+                    loc = loc[0:4]
+
+            nrspots += 1
+            yield make_spot(int(row[1]) // 60, call, parse_freq(row[5]), int(row[4]), int(row[9]), loc,
+                            int(row[8].replace('+','')), row[2], row[3], int(row[10]))
+
+    tdiff = time.time() - tstart
+    logging.info("readgz() Total rows: %d, Nr-calls+telem: %d, Time: %.1f s, %d rows/s.", rows, nrspots, tdiff, rows / max(tdiff, 0.001))
+
+
+#
+# Read several GZip files, one file per worker process
+#
+# Returns the spots from all files in one list sorted on time, the same as
+# reading the files one after the other and sorting the result. With
+# store=True a sorted SpotStore is returned, which is also much cheaper to
+# pass back from the workers.
+#
+def readgzfiles(balloons, gzfiles, workers=1, since=None, until=None, ordered=False, store=False):
+    workers = min(workers, len(gzfiles))
+
+    # Workers need fork, otherwise the main script would run again in every worker
+    if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logging.info("readgzfiles() No fork on this platform, reading files serially")
+        workers = 1
+
+    logging.info("readgzfiles() Reading %d files with %d workers", len(gzfiles), workers)
+    if workers > 1:
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results = pool.starmap(readgz, [(balloons, f, since, until, ordered, store) for f in gzfiles])
+    else:
+        results = [readgz(balloons, f, since, until, ordered, store) for f in gzfiles]
+
+    if store:
+        from spotstore import SpotStore
+        spots = SpotStore.concat(results).sort()
+        logging.info("readgzfiles() Total Nr-calls+telem: %d in %.1f MB", len(spots), spots.nbytes() / 1e6)
+        return spots
+
+    spots = []
+    for r in results:
+        spots.extend(r)
+    spots.sort(reverse=False)
+
+    logging.info("readgzfiles() Total Nr-calls+telem: %d", len(spots))
     return spots
 
 
@@ -206,15 +244,16 @@ def readgz(balloons, gzfile):
 # Decode Telemetry from Main and Telemetry Packets together
 #
 def decode_telemetry(spot_pos, spot_tele):
-    logging.info("decode_telemetry() Decoding!\r\n  %s, %s\r\n  %s, %s", spot_pos[0], spot_pos[1:], spot_tele[0], spot_tele[1:])
-
-    spot_pos_time = spot_pos[0]
-    spot_pos_call = spot_pos[1]
-    spot_pos_loc = spot_pos[5]
-    spot_pos_power = spot_pos[6]
-    spot_tele_call = spot_tele[1]
-    spot_tele_loc = spot_tele[5]
-    spot_tele_power = spot_tele[6]
+    logging.info("decode_telemetry() Decoding!\r\n  %s, %s\r\n  %s, %s", format_minute(spot_pos.time), spot_pos[1:10],
+                 format_minute(spot_tele.time), spot_tele[1:10])
+
+    spot_pos_time = minute_datetime(spot_pos.time)
+    spot_pos_call = spot_pos.call
+    spot_pos_loc = spot_pos.loc
+    spot_pos_power = spot_pos.power
+    spot_tele_call = spot_tele.call
+    spot_tele_loc = spot_tele.loc
+    spot_tele_power = spot_tele.power
     
     # Convert call to numbers
     c1 = spot_tele_call[1]
@@ -333,65 +372,99 @@ def decode_telemetry(spot_pos, spot_tele):
 
     return telemetry
 
+#
+# History of sent sentences, sentence -> time sent. None until loaded from db.
+# Uploader threads add to it, sent_lock guards it while it is compacted
+#
+sent_history = None
+sent_lock = threading.Lock()
+
+#
+# Load history of sent sentences from database into memory. After this all
+# checks are answered from memory, the database only gets the inserts.
+#
+def loadsentdb(retention_days=0):
+    global sent_history
+
+    compactsentdb(retention_days)
+
+    history = {}
+    try:
+        for sentstr, time_sent in wsprdb.execute('select sentstr, time_sent from sentspots'):
+            history[sentstr] = time_sent
+    except sqlite3.Error as e:
+        logging.info("loadsentdb() Database error: %s", e)
+        return
+
+    sent_history = history
+    logging.info("loadsentdb() Loaded %d sent sentences", len(sent_history))
+
+
+#
+# Remove sent sentences older than retention_days from database and memory.
+# 0 keeps all.
+#
+def compactsentdb(retention_days):
+    if retention_days <= 0:
+        return
+
+    time_last = str(datetime.datetime.now() - timedelta(days=retention_days))
+    try:
+        wsprdb.execute('delete from sentspots where time_sent < ?', (time_last,))
+        wsprdb.commit()
+    except sqlite3.Error as e:
+        logging.info("compactsentdb() Database error: %s", e)
+        return
+
+    if sent_history:
+        with sent_lock:
+            old = [k for k, v in list(sent_history.items()) if v < time_last]
+            for k in old:
+                del sent_history[k]
+        logging.info("compactsentdb() Removed %d sentences older than %d days", len(old), retention_days)
+
+
 #
 # Check if sentance is in history of sent spots, 
-#   if so return True, if not commit sentance to database and return False
+#   if so return True, if not return False
 #
 def checkifsentdb(sentence):
-    con = None
-    try:
-        con = sqlite3.connect('wsprdb.db')
-        cur = con.cursor()
-        cur.execute('select * from sentspots where sentstr=?', (sentence,))
-        data = cur.fetchall()
+    if sent_history is not None:
+        return sentence in sent_history
 
-#        for row in data:
-#            logging.info("found", row)
+    try:
+        data = wsprdb.execute('select 1 from sentspots where sentstr=? limit 1', (sentence,))
         if len(data) > 0:
-            if con:
-                con.close()
             return True
-        if not data:
-            con.commit()
     except sqlite3.Error as e:
         logging.info("checkifsentdb() Database error: %s", e)
     except Exception as e:
         logging.info("checkifsentdb() Exception in _query: %s", e)
-    finally:
-        if con:
-            con.close()
 
     return False
 
 
 #
-# Add Sentence to database
+# Add Sentence to database, committed at end of polling cycle
 #
 def addsentdb(name, time_rec, sentence):
-    con = None
     time_sent = datetime.datetime.now()
     
     try:
-        con = sqlite3.connect('wsprdb.db')
-        cur = con.cursor()
-#         cur.execute('drop table if exists sentspots')
-        cur.execute('create table if not exists sentspots(name varchar(15),time_sent varchar(20), time_received varchar(20), sentstr varchar(50))')
-        cur.execute("INSERT INTO sentspots VALUES(?,?,?,?)", (name, time_sent, time_rec, sentence))
-        data = cur.fetchall()
-        if not data:
-            con.commit()
+        wsprdb.execute("INSERT INTO sentspots VALUES(?,?,?,?)", (name, str(time_sent), time_rec, sentence))
     except sqlite3.Error as e:
         logging.info("addsentdb() Database error: %s", e)
     except Exception as e:
         logging.info("addsentdb() Exception in _query: %s", e)
-    finally:
-        if con:
-            con.close()
+
+    if sent_history is not None:
+        with sent_lock:
+            sent_history[sentence] = str(time_sent)
 
     return
 
 #
-# Send sentance to HabHub
+# Send sentance to HabHub. Returns True if uploaded now or before
 #
 def send_tlm_to_habitat(sentence, callsign, spot_time):
     input=sentence
@@ -423,23 +496,25 @@ def send_tlm_to_habitat(sentence, callsign, spot_time):
 
     logging.info("send_tlm_to_habitat() sending %s.", sentence)
 
-    h = httplib2.Http("")
-
-    resp, content = h.request(
-        uri="http://habitat.habhub.org:/habitat/_design/payload_telemetry/_update/add_listener/%s" % hashlib.sha256(sentence2).hexdigest(),
-        method='PUT',
-        headers={'Content-Type': 'application/json; charset=UTF-8'},
-        body=json.dumps(data),
-    )
-
-    if resp['status'] == '201':
+    try:
+        resp = httpclient.put(
+            "http://habitat.habhub.org/habitat/_design/payload_telemetry/_update/add_listener/%s" % hashlib.sha256(sentence2).hexdigest(),
+            headers={'Content-Type': 'application/json; charset=UTF-8'},
+            data=json.dumps(data),
+        )
+    except requests.exceptions.RequestException as e:
+        logging.info("send_tlm_to_habitat() ERROR: %s", e)
+        return False
+
+    if resp.status_code == 201:
         logging.info("Habhub says: 201 - OK.")
-    elif resp['status'] == '403':
+    elif resp.status_code == 403:
         logging.info("Habhub says: 403 - Error already uploaded.")
     else:
-        logging.info("Unknown response: %s.", resp['status'])
+        logging.info("Unknown response: %s.", resp.status_code)
+        return False
 
-    return
+    return True
 
 
 #
@@ -451,7 +526,7 @@ def timetrim(spots, m):
 
     pre = len(spots)
 
-    time_last = datetime.datetime.utcnow() - timedelta(minutes=m)
+    time_last = minutes_ago(m)
     spotc = 0
     splitspotc = 0
 
@@ -459,7 +534,7 @@ def timetrim(spots, m):
     for r in spots:
         spotc += 1
 #        logging.info(r[0], "vs ", time_last)
-        if r[0] < time_last:
+        if r.time < time_last:
             splitspotc = spotc
 
     l = len(spots)
@@ -471,18 +546,250 @@ def timetrim(spots, m):
 
 
 #
-# Main function - filter, process and upload of telemetry
+# Key of the transmission a spot is a report of, (time, call, locator, power, band)
+#
+def transmission_key(row):
+    return (row.time, row.call, row.loc, row.power, row.freq // 1000000)
+
+
+#
+# Collapse reports of the same transmission into one record
+#
+# One transmission is often heard by tens of reporters. Reports are grouped on
+# transmission_key(), each record is a Transmission with the fields of the
+# first report of its group and the (reporter, reporter locator, snr, drift,
+# distance) of all reports. Records are in order of their first report.
+#
+def aggregate_spots(spots):
+    records = {}
+    for row in spots:
+        k = transmission_key(row)
+        rec = records.get(k)
+        if rec is None:
+            rec = records[k] = (row, [])
+        rec[1].append((row.reporter, row.reporter_loc, row.snr, row.drift, row.distance))
+
+    return [Transmission(*row, tuple(reporters)) for row, reporters in records.values()]
+
+
+#
+# Channel of a telemetry call, 0-9 is 0x9.., 10-19 is Qx9..
+#
+def telemetry_channel(call):
+    channel = ord(call[2]) - 48
+    if call[0] == 'Q':
+        channel += 10
+    return channel
+
+
+#
+# Index spots on what process_telemetry() looks up per balloon
 #
-def process_telemetry(spots, balloons, habhub_callsign, push_habhub, push_aprs):
+# Each spot is classified once. All spots are indexed on call. Telemetry spots
+# are also indexed on (channel, band, timeslot), and on (channel, band, None)
+# for balloons that don't use timeslots. Channel 0-9 is telemetry call 0x9..,
+# channel 10-19 is Qx9.., band is the MHz part of the frequency.
+#
+def index_spots(spots):
+    pos_index = {}
+    tele_index = {}
 
-    # Copy all telemetry packets into spots_tele
-    spots_tele = []
     for row in spots:
-        # logging.info(row)
-        if re.match('(^0|^Q).[0-9].*', row[1]):
-            #         logging.info(', '.join(row))
-            #if re.match('10\..*', row[2]) or re.match('14\..*', row[2]):
-            spots_tele.append(row)
+        call = row.call
+        pos_index.setdefault(call, []).append(row)
+
+        if is_telemetry_call(call):
+            channel = telemetry_channel(call)
+            band = row.freq // 1000000
+
+            # Epoch minutes and minutes of the hour are the same mod 10
+            slot = row.time % 10 // 2
+            tele_index.setdefault((channel, band, slot), []).append(row)
+            tele_index.setdefault((channel, band, None), []).append(row)
+
+    return pos_index, tele_index
+
+
+#
+# Pair balloon position spots with telemetry spots
+#
+# For every position spot with a new time, the telemetry spots 0 < t <= 8 min
+# after it are paired with it. The telemetry is indexed on time so each spot
+# is a bisect instead of a scan of the telemetry list. The first telemetry
+# spot in each pair is the one to decode.
+#
+def pair_telemetry(bspots, telem):
+    telem = sorted(telem, key=lambda r: r.time)
+    telem_times = [r.time for r in telem]
+
+    pairs = []
+    spot_oldtime = None
+    for row in bspots:
+        spot_time = row.time
+
+        # Only check new uniq times
+        if spot_time == spot_oldtime:
+            continue
+        spot_oldtime = spot_time
+
+        i = bisect.bisect_right(telem_times, spot_time)
+        j = bisect.bisect_right(telem_times, spot_time + 8, i)
+        pairs.append((row, telem[i:j]))
+
+    return pairs
+
+
+#
+# Pairs already decoded, (balloon name, position transmission, telemetry
+# transmission) -> spot time. A pair is remembered when its sentence is sent,
+# was sent before or doesn't decode, so process_telemetry() skips it in later
+# cycles. Pairs with uploads still pending or failed are decoded again.
+#
+decoded_pairs = {}
+
+
+#
+# Add sentence to sent history and remember the pair it was decoded from
+#
+def addsentpair(pair_key, name, time_rec, sentence):
+    addsentdb(name, time_rec, sentence)
+    # Time of the position transmission
+    decoded_pairs[pair_key] = pair_key[1][0]
+
+
+#
+# Forget decoded pairs with a position transmission before minute first
+#
+def expire_pairs(first):
+    for k, t in list(decoded_pairs.items()):
+        if t < first:
+            del decoded_pairs[k]
+
+
+#
+# Decode a position transmission and its telemetry transmissions for balloon
+# b, and queue the uploads of the sentence if it is new. block=True waits for
+# room in the upload queues, see uploader.submit(). Returns the pair key
+#
+def decode_pair(b, row, b_telem, habhub_callsign, push_habhub, push_aprs, block=False):
+    balloon_name = b[0]
+    balloon_append = b[5]
+    spot_time = row.time
+
+    # Skip pairs done in an earlier cycle
+    pair_key = (balloon_name, transmission_key(row), transmission_key(b_telem[0]))
+    if pair_key in decoded_pairs:
+        return pair_key
+
+    logging.info("process_telem() Found %d suitable pairs for decoding",len(b_telem))
+
+    # logging.info("call", spot_call,"time",spot_time,"fq",spot_fq,"loc", spot_loc,"power",spot_power,"reporter",spot_reporter)
+    #logging.info(pstr)
+    #logging.info("T: %s", b_telem[0])
+    telemetry = decode_telemetry(row, b_telem[0])
+
+    # KW If we want to upload the same spot as different call signs this tops us
+    # KW We already check for duplicate uploads below, so dont remove used spots here
+    if len(telemetry) > 0:
+    #    # Delete spot and telemetryspot
+    #    try:
+    #        spots.remove(row)
+    #    except ValueError:
+    #        pass
+
+    #    for rt in b_telem:
+    #        pstr = "%s Time: %s Fq: %s Loc: %s Power: %s Reporter: %s" %  (rt[1], rt[0], rt[2], rt[5], rt[6], rt[7]) 
+    #        #logging.info("Removing: %s", pstr)
+    #        try:
+    #            spots.remove(rt)
+    #        except ValueError:
+    #            pass
+
+    #        try:
+    #            spots_tele.remove(rt)
+    #        except ValueError:
+    #            pass
+
+    #        try:
+    #            telem.remove(rt)
+    #        except ValueError:
+    #            pass
+
+    #    # logging.info(telemetry)
+
+        # seqnr = int(((int(telemetry['time'].strftime('%s'))) / 120) % 100000)
+        seqnr = int(telemetry['time'].strftime('%s'))
+
+        # telemetry = [ spot_pos_time, spot_pos_call, lat, lon, loc, alt, temp, batt, speed, gps, sats ]
+        telestr = "%s,%d,%s,%.5f,%.5f,%d,%d,%.2f,%.2f,%d,%d" % (  
+            balloon_name, seqnr, telemetry['time'].strftime('%H:%M'), telemetry['lat'], telemetry['lon'],
+            telemetry['alt'], telemetry['speed'], telemetry['temp'], telemetry['batt'], telemetry['gps'], telemetry['sats'])
+
+        # Calculate and add XOR-checksum
+        i=0
+        checksum = 0
+        while i < len(telestr):
+            checksum = checksum ^ ord(telestr[i])
+            i+=1
+        telestr = "$$" + telestr + "*" + '{:x}'.format(int(checksum))
+        #logging.info("Telemetry: %s", telestr)
+
+        # Check if string has been uploaded before or is being uploaded, and if not then queue upload
+        if not checkifsentdb(telestr) and not uploader.is_pending(telestr):
+            # logging.info("Unsent spot", telestr)
+            uploads = []
+
+            logging.info("process_telem() Habhub data: %s", telestr)
+            if push_habhub == "True":
+                # Send telemetry to habhub
+                logging.info("process_telem() Pushing data to habhub")
+                uploads.append(('habhub', send_tlm_to_habitat, (telestr, habhub_callsign, telemetry['time'])))
+
+            # Prep basic data for aprs.fi
+            sonde_data = {}
+            sonde_data["id"] = balloon_append
+            sonde_data["lat"] = telemetry['lat']
+            sonde_data["lon"] = telemetry['lon']
+            sonde_data["alt"] = telemetry['alt']
+
+            logging.info("process_telem() Aprs.fi data: %s", sonde_data)
+            if push_aprs == "True":
+                # Send telemetry to aprs.fi
+                logging.info("process_telem() Pushing data to aprs.fi")
+                uploads.append(('aprs', push_balloon_to_aprs, (sonde_data, telestr)))
+
+            # Add sent string to history-db when all uploads are confirmed
+            uploader.submit(telestr, uploads, addsentpair, (pair_key, balloon_name, telemetry['time'], telestr), block)
+
+        else:
+            logging.info("process_telem() Already sent spot. Doing nothing")
+            if not uploader.is_pending(telestr):
+                decoded_pairs[pair_key] = spot_time
+
+    else:
+        # Doesn't decode, no use trying again
+        decoded_pairs[pair_key] = spot_time
+
+    return pair_key
+
+#
+# Main function - filter, process and upload of telemetry
+#
+# block=True for runs over a file, uploads wait for room in the queues
+# instead of being left for the next polling cycle
+#
+def process_telemetry(spots, balloons, habhub_callsign, push_habhub, push_aprs, block=False):
+
+    # Pair and decode once per transmission, not per report. A SpotStore
+    # groups its reports itself
+    if hasattr(spots, 'transmissions'):
+        transmissions = spots.transmissions()
+    else:
+        transmissions = aggregate_spots(spots)
+    logging.info("process_telem() %d transmissions from %d spots", len(transmissions), len(spots))
+
+    # Classify all transmissions once and index them for the balloon lookups below
+    pos_index, tele_index = index_spots(transmissions)
 
     # 2018-05-03 13:06:00, QA5IQA, 7.040161, -8, JO53, 27, DH5RAE, JN68qv, 537
     # 0                    1       2         3   4     5   6       7       8 
@@ -503,154 +810,114 @@ def process_telemetry(spots, balloons, habhub_callsign, push_habhub, push_aprs):
 
         logging.info("process_telem() Looking for: Name: %-8s Call: %6s MHz: %2d Channel: %2d Slot: %d" % (balloon_name, balloon_call, balloon_mhz, balloon_channel, balloon_timeslot))
 
-        # Filter out telemetry for active channel
-        if balloon_channel < 10:
-            telem = [element for element in spots_tele if re.match('^0.'+str(balloon_channel), element[1])]
+        # Telemetry for active channel and band, and timeslot if used
+# KW        if balloon_timeslot > 0: # doesnt work for min 0 Telemetry!  
+        if balloon_timeslot < 9:
+            telem = tele_index.get((balloon_channel, balloon_mhz, balloon_timeslot), [])
         else:
-            telem = [element for element in spots_tele if re.match('^Q.'+str(balloon_channel-10), element[1])]
+            telem = tele_index.get((balloon_channel, balloon_mhz, None), [])
 
-        # Filter out only selected band
-        telem = [element for element in telem if re.match(str(balloon_mhz)+'\..*', element[2])]
+        # My primary balloon spots
+        bspots = pos_index.get(balloon_call, [])
 
-        # If timeslot is used. filter out correct slot
-# KW        if balloon_timeslot > 0: # doesnt work for min 0 Telemetry!  
-        if balloon_timeslot < 9:
-            telem = [element for element in telem if balloon_timeslot == int(element[0].minute % 10 / 2)]
-                                
-        #if len(telem) > 0:
-        #    logging.info("time at top-tele spot: %s", str(telem[0]))
-
-        # Copy my primary balloon spots from spots into bspots
-        spot_last = spots[0]
-        spot_oldtime = datetime.datetime(1970, 1, 1, 1, 1)
-        bspots = []
-        for row in spots:
-            if balloon_call == row[1]:
-                bspots.append(row)
-                
         logging.info("process_telem() Found %d balloon spots and %d possible telelmetry packets", len(bspots), len(telem))
         for r in bspots:
-            logging.info("process_telem()   Found: %s, %s", r[0], r[1:])
+            logging.info("process_telem()   Found: %s, %s Reporters: %d", format_minute(r.time), r[1:10], len(r.reporters))
         for r in telem:
-            logging.info("process_telem()   Found: %s, %s", r[0], r[1:])
-
-        for row in bspots:
-            # logging.info("B: %s",row)
-            spot_call = row[1]
-            
-            if balloon_call == spot_call:
-                spot_time = row[0]
-
-                # Only check new uniq times
-                if spot_time != spot_oldtime:
-
-                    # [datetime.datetime(2019, 8, 1, 0, 22), 'YO3ICT', '14.097148', -23, -1, 'BM73', 10, 'ND7M', 'DM16', 2564]
-                    pstr = "Call: %s Time: %s Fq: %s Loc: %s Power: %s Reporter: %s" %  (row[1], row[0], row[2], row[5], row[6], row[7])
-                    #logging.info(pstr)
-                    spot_oldtime = spot_time
-                    spot_fq = row[2]
-                    spot_power = row[4]
-                    spot_loc = row[5]
-                    spot_reporter = row[6]        
-                    spot_reporter_loc = row[7]
-                    
-                # Match positioningpacket with telemetrypackets
-                    b_telem = []
-                    for trow in telem:
-                        # logging.info("tdiff:",trow, spot_time, type(spot_time))
-                        tdiff = trow[0] - spot_time
-                        #                    logging.info(tdiff)
-
-                        if tdiff > timedelta(minutes=8):
-                            logging.info("process_telem() Interval longer than 8 min (%s), breaking.", str(tdiff))
-                            break
-                        if tdiff > timedelta(minutes=0):
-                            b_telem.append(trow)
-
-                    # If suitable telemetry found, enter decoding!
-                    if len(b_telem) > 0:
-                        logging.info("process_telem() Found %d suitable pairs for decoding",len(b_telem))
-
-                        # logging.info("call", spot_call,"time",spot_time,"fq",spot_fq,"loc", spot_loc,"power",spot_power,"reporter",spot_reporter)
-                        #logging.info(pstr)
-                        #logging.info("T: %s", b_telem[0])
-                        telemetry = decode_telemetry(row, b_telem[0])
-
-                        # KW If we want to upload the same spot as different call signs this tops us
-                        # KW We already check for duplicate uploads below, so dont remove used spots here
-                        if len(telemetry) > 0:
-                        #    # Delete spot and telemetryspot
-                        #    try:
-                        #        spots.remove(row)
-                        #    except ValueError:
-                        #        pass
-
-                        #    for rt in b_telem:
-                        #        pstr = "%s Time: %s Fq: %s Loc: %s Power: %s Reporter: %s" %  (rt[1], rt[0], rt[2], rt[5], rt[6], rt[7]) 
-                        #        #logging.info("Removing: %s", pstr)
-                        #        try:
-                        #            spots.remove(rt)
-                        #        except ValueError:
-                        #            pass
-
-                        #        try:
-                        #            spots_tele.remove(rt)
-                        #        except ValueError:
-                        #            pass
-
-                        #        try:
-                        #            telem.remove(rt)
-                        #        except ValueError:
-                        #            pass
-
-                        #    # logging.info(telemetry)
-
-                            # seqnr = int(((int(telemetry['time'].strftime('%s'))) / 120) % 100000)
-                            seqnr = int(telemetry['time'].strftime('%s'))
-
-                            # telemetry = [ spot_pos_time, spot_pos_call, lat, lon, loc, alt, temp, batt, speed, gps, sats ]
-                            telestr = "%s,%d,%s,%.5f,%.5f,%d,%d,%.2f,%.2f,%d,%d" % (  
-                                balloon_name, seqnr, telemetry['time'].strftime('%H:%M'), telemetry['lat'], telemetry['lon'],
-                                telemetry['alt'], telemetry['speed'], telemetry['temp'], telemetry['batt'], telemetry['gps'], telemetry['sats'])
-
-                            # Calculate and add XOR-checksum
-                            i=0
-                            checksum = 0
-                            while i < len(telestr):
-                                checksum = checksum ^ ord(telestr[i])
-                                i+=1
-                            telestr = "$$" + telestr + "*" + '{:x}'.format(int(checksum))
-                            #logging.info("Telemetry: %s", telestr)
-
-                            # Check if string has been uploaded before and if not then add and upload
-                            if not checkifsentdb(telestr):
-                                # logging.info("Unsent spot", telestr)
-
-                                logging.info("process_telem() Habhub data: %s", telestr)
-                                if push_habhub == "True":
-                                    # Send telemetry to habhub
-                                    logging.info("process_telem() Pushing data to habhub")
-                                    send_tlm_to_habitat(telestr, habhub_callsign, spot_time)                            
-
-                                # Prep basic data for aprs.fi
-                                sonde_data = {}
-                                sonde_data["id"] = balloon_append
-                                sonde_data["lat"] = telemetry['lat']
-                                sonde_data["lon"] = telemetry['lon']
-                                sonde_data["alt"] = telemetry['alt']
-
-                                logging.info("process_telem() Aprs.fi data: %s", sonde_data)
-                                if push_aprs == "True":
-                                    # Send telemetry to aprs.fi
-                                    logging.info("process_telem() Pushing data to aprs.fi")
-                                    push_balloon_to_aprs(sonde_data, telestr)
-
-
-                                # Add sent string to history-db
-                                addsentdb(balloon_name, row[0], telestr)
-
-                            else:
-                                logging.info("process_telem() Already sent spot. Doing nothing")
+            logging.info("process_telem()   Found: %s, %s Reporters: %d", format_minute(r.time), r[1:10], len(r.reporters))
+
+        # Match positioningpackets with telemetrypackets
+        for row, b_telem in pair_telemetry(bspots, telem):
+            # If suitable telemetry found, enter decoding!
+            if len(b_telem) > 0:
+                decode_pair(b, row, b_telem, habhub_callsign, push_habhub, push_aprs, block)
+
+    # Forget pairs that have left the window
+    if transmissions:
+        expire_pairs(min(r.time for r in transmissions))
 
     return spots
 
+
+
+#
+# Pairs decoded in process_window() whose uploads were still pending or
+# failed, pair key -> minute of the position transmission. They are tried
+# again next cycle even if no spots came for their minutes.
+#
+retry_pairs = {}
+
+
+#
+# Live mode version of process_telemetry() over a SpotWindow
+#
+# Only the minutes that got spots since the last cycle are grouped into
+# transmissions and logged, and only the position transmissions in or up to
+# 8 minutes before those minutes are paired again, as the pairs of the other
+# positions can't have changed. Pairs to retry are added to those. Steady
+# state work follows the new spots instead of the window size.
+#
+def process_window(window, balloons, habhub_callsign, push_habhub, push_aprs):
+    changed = window.pop_changed()
+    first = window.start
+    if first is None:
+        return 0
+
+    # Transmissions per minute, grouped once per cycle
+    cache = {}
+    def transmissions(m):
+        if m not in cache:
+            cache[m] = aggregate_spots(window.minute(m))
+        return cache[m]
+
+    nrtrans = 0
+    for m in changed:
+        for r in transmissions(m):
+            nrtrans += 1
+            logging.info("process_window()   Found: %s, %s Reporters: %d", format_minute(r.time), r[1:10], len(r.reporters))
+    logging.info("process_window() %d transmissions in %d changed minutes", nrtrans, len(changed))
+
+    # Positions whose pairs could have changed, and pairs to retry
+    check = set()
+    for m in changed:
+        check.update(range(m - 8, m + 1))
+    for k, m in list(retry_pairs.items()):
+        if k in decoded_pairs or m < first:
+            del retry_pairs[k]
+        else:
+            check.add(m)
+    check = sorted(m for m in check if m >= first)
+
+    nrpairs = 0
+    for b in balloons:
+        balloon_call = b[1]
+        balloon_mhz = b[2]
+        balloon_channel = b[3]
+        balloon_timeslot = b[4]
+
+        for m in check:
+            # First position transmission of the minute, like pair_telemetry()
+            row = next((r for r in transmissions(m) if r.call == balloon_call), None)
+            if row is None:
+                continue
+
+            # Telemetry on the channel and band, and timeslot if used, 0 < t <= 8 min after it
+            b_telem = []
+            for t in range(m + 1, m + 9):
+                for r in transmissions(t):
+                    if (is_telemetry_call(r.call) and telemetry_channel(r.call) == balloon_channel and
+                            r.freq // 1000000 == balloon_mhz and (balloon_timeslot >= 9 or r.time % 10 // 2 == balloon_timeslot)):
+                        b_telem.append(r)
+
+            if b_telem:
+                nrpairs += 1
+                pair_key = decode_pair(b, row, b_telem, habhub_callsign, push_habhub, push_aprs)
+                if pair_key not in decoded_pairs:
+                    retry_pairs[pair_key] = m
+
+    logging.info("process_window() Checked %d minutes, %d pairs, %d to retry", len(check), nrpairs, len(retry_pairs))
+
+    # Forget pairs that have left the window
+    expire_pairs(first)
+
+    return nrpairs
@@ -0,0 +1,159 @@
+#
+# Asynchronous upload of telemetry to habhub and APRS
+#
+# process_telemetry() only queues uploads here, the network work is done by
+# worker threads, one bounded queue and set of workers per destination. A
+# failed upload is retried with exponential backoff. When all uploads of a
+# sentence are confirmed the done callback is run, normally adding the
+# sentence to the sent-history. If any upload finally fails the sentence is
+# forgotten, so it is decoded and queued again next polling cycle.
+#
+
+import logging
+import queue
+import threading
+import time
+
+queue_size = 100
+retries = 3
+backoff = 5         # Seconds, doubled for every retry
+
+_destinations = {}  # name -> destination state
+_pending = {}       # sentence -> [destinations left, failed, done callback, args]
+_lock = threading.Lock()
+
+
+#
+# Set up a destination with its own queue and worker threads
+#
+def add_destination(name, workers=1):
+    with _lock:
+        if name in _destinations:
+            return
+
+        d = {'queue': queue.Queue(queue_size), 'threads': [],
+             'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0,
+             'latency_total': 0.0, 'latency_max': 0.0}
+        _destinations[name] = d
+
+    for i in range(workers):
+        t = threading.Thread(target=_worker, args=(name, d), name="upload-%s-%d" % (name, i), daemon=True)
+        t.start()
+        d['threads'].append(t)
+
+
+#
+# Check if sentence is queued or being uploaded
+#
+def is_pending(sentence):
+    with _lock:
+        return sentence in _pending
+
+
+#
+# Queue uploads of sentence. uploads is a list of (destination, function, args),
+# function returns True when the upload is confirmed. done(*done_args) is run
+# once all uploads are confirmed. By default never blocks, if a queue is full
+# the sentence is dropped and will be tried again next polling cycle. Runs
+# over a file have no next cycle, with block=True they wait for room in the
+# queue instead.
+#
+def submit(sentence, uploads, done, done_args=(), block=False):
+    if not uploads:
+        done(*done_args)
+        return True
+
+    with _lock:
+        if sentence in _pending:
+            return True
+        _pending[sentence] = [len(uploads), False, done, done_args]
+
+    for name, func, args in uploads:
+        add_destination(name)
+        try:
+            _destinations[name]['queue'].put((sentence, func, args), block)
+        except queue.Full:
+            logging.info("uploader.submit() Queue for %s full, dropping %s", name, sentence)
+            with _lock:
+                _destinations[name]['dropped'] += 1
+            _finish(sentence, False)
+
+    return True
+
+
+#
+# One upload of sentence is finished
+#
+def _finish(sentence, ok):
+    with _lock:
+        p = _pending.get(sentence)
+        if not p:
+            return
+        p[0] -= 1
+        if not ok:
+            p[1] = True
+        if p[0] > 0:
+            return
+        del _pending[sentence]
+
+    if p[1]:
+        logging.info("uploader() Upload of %s failed, not adding to sent history", sentence)
+        return
+
+    try:
+        p[2](*p[3])
+    except Exception as e:
+        logging.info("uploader() Exception in done callback: %s", e)
+
+
+def _worker(name, d):
+    while True:
+        sentence, func, args = d['queue'].get()
+
+        ok = False
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                with _lock:
+                    d['retried'] += 1
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+            tstart = time.time()
+            try:
+                ok = func(*args)
+            except Exception as e:
+                logging.info("uploader() %s upload error: %s", name, e)
+                ok = False
+            latency = time.time() - tstart
+
+            with _lock:
+                d['latency_total'] += latency
+                d['latency_max'] = max(d['latency_max'], latency)
+            if ok:
+                break
+
+        with _lock:
+            if ok:
+                d['sent'] += 1
+            else:
+                d['failed'] += 1
+
+        _finish(sentence, ok)
+        d['queue'].task_done()
+
+
+#
+# Wait for all queued uploads to finish
+#
+def join():
+    for d in list(_destinations.values()):
+        d['queue'].join()
+
+
+def stats():
+    s = []
+    for name, d in _destinations.items():
+        tries = d['sent'] + d['failed'] + d['retried']
+        s.append("%s: Queue: %d Sent: %d Failed: %d Retried: %d Dropped: %d Latency avg: %.2f max: %.2f (s)" %
+                 (name, d['queue'].qsize(), d['sent'], d['failed'], d['retried'], d['dropped'],
+                  d['latency_total'] / max(tries, 1), d['latency_max']))
+    return " | ".join(s)
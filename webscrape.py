@@ -1,134 +1,49 @@
 #!/usr/bin/python3
 
-from bs4 import BeautifulSoup  
 import configparser
 import csv
 import datetime
 import getopt
+import glob
 import os
-import requests
 import sqlite3
 import sys
 import time
 
+import gzindex
+import httpclient
+import pipeline
+import snapshot
+import uploader
+import wsprdb
+
 from balloon import *
+from spotcache import SpotCache
+from spotwindow import SpotWindow
 from telemetry import *
+from wsprnet import *
 
-#
-# Get Spots from wsprnet.org
-#
-def getspots (nrspots):
-    logging.info("getspots() Fetching %d Spots from wsprnet.org old database.", nrspots)
-    # KW force 20m only wiki = "http://wsprnet.org/olddb?mode=html&band=all&limit=" + str(nrspots) + "&findcall=&findreporter=&sort=spotnum"
-    wiki = "http://wsprnet.org/olddb?mode=html&band=20&limit=" + str(nrspots) + "&findcall=&findreporter=&sort=spotnum"
-    try:
-        page = requests.get(wiki)
-    except requests.exceptions.RequestException as e:
-        logging.info("ERROR: %s",e)
-        return []
-
-#    logging.info(page.status)
-#    logging.info(page.data)
-
-    soup = BeautifulSoup(page.content, 'html.parser')
-
-    data = []
-    table = soup.find_all('table')[2]
-    # logging.info("TABLE:",table)
-
-    rows = table.findAll('tr')
-    for row in rows:
-        cols = row.find_all('td')
-        cols = [ele.text.strip() for ele in cols]
-        data.append([ele for ele in cols if ele]) # Get rid of empty values
-
-    # Strip empty rows
-    newspots = [ele for ele in data if ele] 
-
-    # Strip redundant columns Watt & miles and translate/filter data
-    for row in newspots:
-        row[0] = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M')
-        row[6] = int(row[6].replace('+',''))
-
-        del row[11]
-        del row[7]
-
-    # Reverse the sorting order of time to get new spots firsts
-    newspots.reverse()
-
-    return newspots
-
-#
-# Get Spots from wsprnet.org
-#
-def gettestspots (nrspots, call):
-    logging.info("gettestspots() Fetching %d Spots from wsprnet.org old database.", nrspots)
-    wiki = "http://wsprnet.org/olddb?mode=html&band=20&limit=" + str(nrspots) + "&findcall=" + call + "&findreporter=&sort=spotnum"
-    try:
-        page = requests.get(wiki)
-    except requests.exceptions.RequestException as e:
-        logging.info("ERROR: %s",e)
-        return []
-
-#    logging.info(page.status)
-#    logging.info(page.data)
-
-    soup = BeautifulSoup(page.content, 'html.parser')
-
-    data = []
-    table = soup.find_all('table')[2]
-    # logging.info("TABLE:",table)
-
-    rows = table.findAll('tr')
-    for row in rows:
-        cols = row.find_all('td')
-        cols = [ele.text.strip() for ele in cols]
-        data.append([ele for ele in cols if ele]) # Get rid of empty values
-
-    # Strip empty rows
-    newspots = [ele for ele in data if ele]
-
-    # Strip redundant columns Watt & miles and translate/filter data
-    for row in newspots:
-        row[0] = datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M')
-        row[6] = int(row[6].replace('+',''))
-
-        del row[11]
-        del row[7]
-
-    # Reverse the sorting order of time to get new spots firsts
-    newspots.reverse()
-
-    return newspots
-
+# Columnar spot store for archive mode, needs numpy
+try:
+    import spotstore
+except ImportError:
+    spotstore = None
 
 # 
-# Dump new spots to db. Note stripping of redundant fields
+# Dump new spots to db, committed at end of polling cycle. Note stripping of redundant fields
 #
 # Example: 2018-05-28 05:50,OM1AI,7.040137,-15,0,JN88,+23,DA5UDI,JO30qj,724
 #
 def dumpnewdb(spotlist):
-    con = None
-    data = None
-    
     try:
-        con = sqlite3.connect('wsprdb.db')
-        cur = con.cursor()
-        cur.execute('create table if not exists newspots(timestamp varchar(20), tx_call varchar(10), freq real, snr integer, drift integer, tx_loc varchar(6), power integer, rx_call varchar(10), rx_loc varchar(6), distance integer)')
         for row in spotlist:
             logging.info(row)
-            cur.execute("INSERT INTO newspots VALUES(?,?,?,?,?,?,?,?,?,?)", (row))
-            data = cur.fetchall()
-
-        if not data:
-            con.commit()
+        wsprdb.executemany("INSERT INTO newspots VALUES(?,?,?,?,?,?,?,?,?,?)",
+                           [(format_minute(row.time), row.call, format_freq(row.freq)) + row[3:10] for row in spotlist])
     except sqlite3.Error as e:
         logging.info("Database error: %s", e)
     except Exception as e:
         logging.info("Exception in _query: %s", e)
-    finally:
-        if con:
-            con.close()
     return
 
 
@@ -145,26 +60,25 @@ def balloonfilter(spots,balloons):
 
     for row in spots:
         for c in calls:
-            if row[1] == c:
+            if row.call == c:
 
                 # Remove selfmade WSPR tranmissions
-                if len(row[5]) == 4:
+                if len(row.loc) == 4:
                     filtered.append(row)
                 else:
-                    row[5] = row[5][0:4]
-                    filtered.append(row)
+                    filtered.append(row._replace(loc=sys.intern(row.loc[0:4])))
 
-        if re.match('(^0|^Q).[0-9].*', row[1]):
+        if re.match('(^0|^Q).[0-9].*', row.call):
             filtered.append(row)
 
     for r in filtered:
-        logging.info("balloonfilter() Found: %s, %s", r[0], r[1:])
+        logging.info("balloonfilter() Found: %s, %s", format_minute(r.time), r[1:])
 
     logging.info("balloonfilter() In: %d Out: %d", len(spots), len(filtered))
     return filtered
 
 #
-# De duplicate spots
+# De duplicate spots, same time, call and band
 #
 # Example: 2018-05-28 05:50,OM1AI,7.040137,-15,0,JN88,+23,DA5UDI,JO30qj,724
 #
@@ -175,7 +89,8 @@ def deduplicate(spotlist):
     rc_max = len(spotlist)-1
     if rc_max > 1:
         while rc < rc_max:
-            if (spotlist[rc][0] == spotlist[rc+1][0]) and (spotlist[rc][1] == spotlist[rc+1][1]):
+            if (spotlist[rc].time == spotlist[rc+1].time) and (spotlist[rc].call == spotlist[rc+1].call) and \
+               (spotlist[rc].freq // 1000000 == spotlist[rc+1].freq // 1000000):
 #                logging.info("Duplicate entry")
                 del spotlist[rc]
                 rc_max -= 1
@@ -186,6 +101,16 @@ def deduplicate(spotlist):
     return spotlist
 
 
+#
+# Parse time given as option, with or without time of day
+#
+def parsetime(s):
+    try:
+        return datetime.datetime.strptime(s, '%Y-%m-%d %H:%M')
+    except ValueError:
+        return datetime.datetime.strptime(s, '%Y-%m-%d')
+
+
 ####################################################################################################
 # Main
 #
@@ -198,10 +123,16 @@ logging.basicConfig(level = level, format = format, handlers = handlers, datefmt
 
 # Get options from arguments
 verbose = False
-archive_file = ''
+archive_files = []
 csv_file = ''
 conf_file = 'balloon.ini'
 dry_run = False
+since = None
+until = None
+ordered = False
+index = False
+batch = False
+workers = os.cpu_count() or 1
 test = False
 
 try:
@@ -211,6 +142,12 @@ try:
                 ['archive=',
                  'csv=',
                  'conf=',
+                 'workers=',
+                 'since=',
+                 'until=',
+                 'ordered',
+                 'index',
+                 'batch',
                 ])
 
 except getopt.GetoptError as err:
@@ -221,11 +158,25 @@ logging.info("main() Options: %s", str(options))
       
 for opt, arg in options:
     if opt in ('--archive'):
-        archive_file = arg
+        # Accept several files, comma separated, repeated and/or as glob patterns
+        for a in arg.split(','):
+            archive_files.extend(sorted(glob.glob(a)) or [a])
     if opt in ('--csv'):
         csv_file = arg
     if opt in ('--conf'):
         conf_file = arg
+    if opt in ('--workers'):
+        workers = int(arg)
+    if opt in ('--since'):
+        since = parsetime(arg)
+    if opt in ('--until'):
+        until = parsetime(arg)
+    if opt in ('--ordered'):
+        ordered = True
+    if opt in ('--index'):
+        index = True
+    if opt in ('--batch'):
+        batch = True
     if opt in ('--dry_run'):
         dry_run = True
     if opt in ('-t', '--test'):
@@ -233,6 +184,9 @@ for opt, arg in options:
     elif opt in ('-v', '--verbose'):
         verbose = True
 
+# Same archive file given twice would give every spot twice
+archive_files = list(dict.fromkeys(archive_files))
+
 # Parse some of balloon config file
 config = configparser.ConfigParser()
 config.read(conf_file)
@@ -242,12 +196,32 @@ habhub_callsign = config['main']['habhub_callsign']
 
 push_aprs = config['main']['push_aprs']
 
+# Fetch all spots of the bands used, or only balloon and telemetry calls
+fetch_mode = config.get('main', 'fetch_mode', fallback='all')
+fetch_wildcard = config.get('main', 'fetch_wildcard', fallback='%')
+fetch_any_char = config.get('main', 'fetch_any_char', fallback='')
+fetch_workers = config.getint('main', 'fetch_workers', fallback=4)
+
+# Days to keep history of sent sentences, 0 keeps all
+sent_retention_days = config.getint('main', 'sent_retention_days', fallback=0)
+
+# Snapshot of live state for a warm start, empty to disable
+snapshot_file = config.get('main', 'snapshot_file', fallback='snapshot.pickle.gz')
+
 balloons = json.loads(config.get('main','balloons'))
             
 logging.info("main() Tracking these balloons:")
 for b in balloons:
       logging.info("  %s", str(b))
 
+# Open database once, shared by all modules
+wsprdb.connect()
+loadsentdb(sent_retention_days)
+
+# Upload workers, habhub takes concurrent uploads, APRS one at a time
+uploader.add_destination('habhub', 2)
+uploader.add_destination('aprs', 1)
+
 if dry_run:
     logging.info("main() Dry run. No uploads")
     push_habhub = False
@@ -263,7 +237,7 @@ if test:
 
       temp_spots = []
       for s in s1:
-          if s[0] > datetime.datetime(2020, 11, 3, 0, 0):
+          if s.time > parse_minute('2020-11-03 00:00'):
               temp_spots.append(s)
       s1 = temp_spots
       logging.info(len(s1))
@@ -273,7 +247,7 @@ if test:
 
       temp_spots = []
       for s in s2:
-          if s[0] > datetime.datetime(2020, 11, 3, 0, 0):
+          if s.time > parse_minute('2020-11-03 00:00'):
               temp_spots.append(s)
       s2 = temp_spots
       logging.info(len(s2))
@@ -290,158 +264,154 @@ if test:
       sys.exit(0)
 
 
-# Load and process spots from archive-file - default append to csv
-if archive_file:
+# Build random access index of archive-files, for --since and --until
+if index:
+      for gzfile in archive_files:
+            gzindex.build(gzfile)
+      sys.exit(0)
+
+# Load and process spots from archive-files - default append to csv
+if archive_files:
       logging.info("main() Archive-mode")
 
-      # Read archivefile and filter out balloondata
-      spots = readgz(balloons, archive_file)
-      logging.info(spots[0])
-      spots.sort(reverse=False)
+      if batch:
+            # Read archivefiles and filter out balloondata, returned sorted on time
+            spots = readgzfiles(balloons, archive_files, workers, since, until, ordered, store=spotstore is not None)
 
-      # Do a crude timetrim 
-      temp_spots = []
-      for s in spots:
-          if s[0] > datetime.datetime(2020, 11, 4, 0, 0):
-              temp_spots.append(s)
-      spots = temp_spots
-      
-      #dumpcsv(spots)
-      #sys.exit(0) # Comment this out to go on and process those spots
+            #dumpcsv(spots)
+            #sys.exit(0) # Comment this out to go on and process those spots
 
-      if len(spots) > 1:
-            logging.info("Spots: %s", str(len(spots)))
-            spots = process_telemetry(spots, balloons,habhub_callsign, push_habhub, push_aprs)
+            if len(spots) > 1:
+                  logging.info("Spots: %s", str(len(spots)))
+                  spots = process_telemetry(spots, balloons,habhub_callsign, push_habhub, push_aprs, block=True)
+            else:
+                  logging.info("No spots!")
       else:
-            logging.info("No spots!")
+            sources = [iter_gz(balloons, f, since, until, ordered) for f in archive_files]
+            pipeline.run(sources, balloons, habhub_callsign, push_habhub, push_aprs)
             
+      uploader.join()
+      logging.info("main() Uploads: %s", uploader.stats())
+      logging.info("main() APRS-IS: %s", aprs_stats())
+      logging.info("main() HTTP: %s", httpclient.stats())
+      wsprdb.close()
       logging.info("Done")
       sys.exit(0)
 
 # Load and process spots from csv-file
 if csv_file:
       logging.info("main() CSV-mode")
-      spots = readcsv(csv_file)
+      if batch:
+            spots = readcsv(csv_file, since, until, ordered)
 
-      # Do a crude trimetrim 
-      # temp_spots = []
-      # for s in spots:
-      #     if s[0] > datetime.datetime(2019, 12, 18, 11, 0) and s[0] < datetime.datetime(2019, 12, 18, 12, 30):
-      #         # logging.info(s)
-      #         temp_spots.append(s)
-      # spots = temp_spots
-
-      
-      if len(spots) > 1:
-            logging.info("main() Spots: %s", str(len(spots)))
-            spots = process_telemetry(spots, balloons, habhub_callsign, push_habhub, push_aprs)
+            if len(spots) > 1:
+                  logging.info("main() Spots: %s", str(len(spots)))
+                  spots = process_telemetry(spots, balloons, habhub_callsign, push_habhub, push_aprs, block=True)
+            else:
+                  logging.info("No spots!")
       else:
-            logging.info("No spots!")
+            pipeline.run([iter_csv(csv_file, since, until, ordered)], balloons, habhub_callsign, push_habhub, push_aprs)
 
+      uploader.join()
+      logging.info("main() Uploads: %s", uploader.stats())
+      logging.info("main() APRS-IS: %s", aprs_stats())
+      logging.info("main() HTTP: %s", httpclient.stats())
+      wsprdb.close()
       logging.info("Done")
       sys.exit(0)
 
 # Spots to pullfrom wsprnet
-nrspots_pull = 8000
-spotcache = []
-
-logging.info("main() Preloading spot cache with 10,000 spots...")
-spotcache = getspots(10000)
-logging.info("main() Got %d spots in cache", len(spotcache))
-spotcache = balloonfilter(spotcache, balloons)
+sleeptime = 90
+if fetch_mode == 'targeted':
+    # Small queries for only balloon and telemetry calls
+    queries = balloon_queries(balloons, fetch_wildcard, fetch_any_char)
+    logging.info("main() Targeted fetch, %d queries every %d s", len(queries), sleeptime)
+    fetcher = MultiBandFetcher(queries, workers=fetch_workers, interval=sleeptime, min_limit=50, catchup=1000)
+else:
+    fetcher = MultiBandFetcher(balloon_bands(balloons), workers=fetch_workers, interval=sleeptime, catchup=10000)
+spotcache = SpotCache(max_age=120, max_size=10000)
+# Spots to be processed, the last 60 minutes
+spotwindow = SpotWindow(max_age=60)
+
+# Warm start from a recent snapshot, then only the spots since it are fetched
+state = snapshot.load(snapshot_file, spotcache.max_age) if snapshot_file else None
+if state:
+    spotcache = state['spotcache']
+    spotwindow = state['spotwindow']
+    fetcher.restore(state['fetcher'])
+    decoded_pairs.update(state['decoded_pairs'])
+    # Pair the whole restored window once, pairs done before are skipped
+    spotwindow.touch()
+    logging.info("main() Warm start with %d spots in cache and %d in window, fetching spots since snapshot...", len(spotcache), len(spotwindow))
+else:
+    logging.info("main() Preloading spot cache with 10,000 spots per band...")
+spots = fetcher.fetch()
+logging.info("main() Got %d spots in cache", len(spots))
+spots = balloonfilter(spots, balloons)
+spotcache.update(spots)
+spotwindow.update(spots)
 
-spots = spotcache
-cache_max = 10000
 new_max = 0
 only_balloon = False
-sleeptime = 90
+compact_day = datetime.date.today()
 
 while 1==1:
     print("\r\n\r\n");
     logging.info("main() Begin polling loop.")
     tnow = datetime.datetime.now() 
 
-    wwwspots = getspots(nrspots_pull)
+    # Only spots arrived since last fetch
+    wwwspots = fetcher.fetch()
     wwwspots = balloonfilter(wwwspots ,balloons)
-    newspots = [] 
 
-    # Sort cache in case some spots arrived out of order
-    spotcache.sort(reverse=False)
     # Use only the last 120 mins of spotcache
     logging.info("main() Timetrim spot cache 120m.")
-    spotcache = timetrim(spotcache,120)
+    spotcache.expire()
 
-    src_cc = 0 
-
-    # Loop through cache and check for new spots
+    # Check fetched spots against cache, unseen spots are added to the cache
     logging.info("main() Removing spots found in our cache.")
-    for row in wwwspots:
-        old = 0
-        for srow in spotcache:
-            # logging.info("testing: ", row, "\nagainst:", srow)
-            src_cc += 1
-            if row == srow:
-                # logging.info("Found %s", row)
-                old = 1
-                break
-
-        if old == 0:
-            logging.info("main() Found new spot: %s, %s", row[0], row[1:])
-            
-            # Insert into cache at the beginning
-            spotcache.insert(0, row)
-
- #           for w in spotcache:
- #               logging.info("cache2: ", w)
-
-            # and add to newspots at the end
-            newspots.append(row)
-
-#     spotcache.sort(reverse=True)
-#    logging.info("first:",spotcache[0][0]," last: ",spotcache[-1:][0][0])
-#    logging.info("DATA:\n")
-#    for row in newspots:
-#        logging.info("Newspots: ", row)
+    newspots = spotcache.update(wwwspots)
+    for row in newspots:
+        logging.info("main() Found new spot: %s, %s", format_minute(row.time), row[1:])
 
 #    dumpcsv(newspots)
 #    dumpnewdb(newspots)
 
-    logging.info("main() Add %d new balloon spots to %d previous spots.", len(newspots), len(spots))
-    spots = spots + newspots
-    spots.sort(reverse=False)   
-    spots = deduplicate(spots) # needs sorted list
-    # Filter out all spots newer than x minutes
+    logging.info("main() Add %d new balloon spots to %d previous spots.", len(newspots), len(spotwindow))
+    spotwindow.update(newspots)
+    # Filter out all spots older than x minutes
     logging.info("main() Timetrim spots to be processed to 60m.")
-    spots = timetrim(spots, 60)
+    spotwindow.expire()
 
-    if len(spots) > 1:
-        logging.info("main() Passing %d spots to process_telemetry().", len(spots))
-        #logging.info(spots);
-        spots = process_telemetry(spots, balloons, habhub_callsign, push_habhub, push_aprs)
-        logging.info("main() %d spots returned from process_telemetry().", len(spots))
+    if len(spotwindow) > 1:
+        # Only the minutes with new spots are paired again
+        logging.info("main() Passing %d spots to process_window().", len(spotwindow))
+        process_window(spotwindow, balloons, habhub_callsign, push_habhub, push_aprs)
 
-    if new_max < len(newspots):
-#  and len(newspots) != nrspots_pull:
-        new_max = len(newspots)
+    # One transaction per polling cycle
+    wsprdb.commit()
+
+    # Save state for a warm start
+    if snapshot_file:
+        snapshot.save(snapshot_file, {'spotcache': spotcache, 'spotwindow': spotwindow,
+                                      'fetcher': fetcher.state(), 'decoded_pairs': dict(decoded_pairs)})
 
-    if len(newspots) == nrspots_pull:
-        logging.info("main() Hit max spots. Increasing set to fetch")
-        nrspots_pull += 100
+    # Clean out old sent sentences once a day
+    if compact_day != datetime.date.today():
+        compact_day = datetime.date.today()
+        compactsentdb(sent_retention_days)
 
-    logging.info("main() Stats this loop: Spots: %5d Cache: %5d New: %5d (max: %5d) Nrspots: %5d Looptime: %5d (s) Checks: %5d" % 
-          (len(spots), len(spotcache), len(newspots), new_max, nrspots_pull, float(str(datetime.datetime.now() - tnow).split(":")[2]), src_cc)) 
+    if new_max < len(newspots):
+        new_max = len(newspots)
 
-    # What does this do?
-    spotcache = spotcache[:cache_max]
+    logging.info("main() Stats this loop: Spots: %5d New: %5d (max: %5d) Looptime: %5d (s) %s" % 
+          (len(spotwindow), len(newspots), new_max, float(str(datetime.datetime.now() - tnow).split(":")[2]), spotcache.stats()))
+    logging.info("main() %s", spotwindow.stats())
+    logging.info("main() Fetch: %s", fetcher.stats())
+    logging.info("main() Uploads: %s", uploader.stats())
+    logging.info("main() APRS-IS: %s", aprs_stats())
+    logging.info("main() HTTP: %s", httpclient.stats())
 
     sleeping = sleeptime - int(datetime.datetime.now().strftime('%s')) % sleeptime
     logging.info("main() Sleep: %d", sleeping)
     time.sleep(sleeping)
-
-
-
-
-
-
-
-        
@@ -0,0 +1,85 @@
+#
+# Shared access to the sqlite database wsprdb.db
+#
+# One connection is opened at startup and used by all modules. The schema is
+# set up once when connecting, the database runs in WAL mode and statements
+# are executed with fixed SQL and parameters, so sqlite3 reuses the compiled
+# statements from its cache. Writes are not committed one by one, call
+# commit() once per polling cycle, or at the end of an archive/csv run.
+#
+
+import logging
+import sqlite3
+import threading
+
+dbfile = 'wsprdb.db'
+
+schema = [
+    'create table if not exists newspots(timestamp varchar(20), tx_call varchar(10), freq real, snr integer, drift integer, tx_loc varchar(6), power integer, rx_call varchar(10), rx_loc varchar(6), distance integer)',
+    'create table if not exists sentspots(name varchar(15),time_sent varchar(20), time_received varchar(20), sentstr varchar(50))',
+    'create table if not exists balloons(name varchar(20), call varchar(10), freq integer, channel integer)',
+    'create index if not exists sentspots_sentstr on sentspots(sentstr)',
+    'create index if not exists sentspots_time_sent on sentspots(time_sent)',
+]
+
+_con = None
+_lock = threading.RLock()
+
+
+#
+# Open the database and set up the schema, if not already done
+#
+def connect(filename=None):
+    global _con, dbfile
+
+    with _lock:
+        if _con:
+            return _con
+
+        if filename:
+            dbfile = filename
+
+        logging.info("wsprdb.connect() Opening %s", dbfile)
+        _con = sqlite3.connect(dbfile, check_same_thread=False, cached_statements=256)
+        _con.execute('pragma journal_mode=wal')
+        _con.execute('pragma synchronous=normal')
+        for sql in schema:
+            _con.execute(sql)
+        _con.commit()
+
+    return _con
+
+
+#
+# Execute statement and return all rows
+#
+def execute(sql, params=()):
+    with _lock:
+        return connect().execute(sql, params).fetchall()
+
+
+#
+# Execute statement for every row in rows
+#
+def executemany(sql, rows):
+    with _lock:
+        connect().executemany(sql, rows)
+
+
+#
+# Commit everything written since last commit
+#
+def commit():
+    with _lock:
+        if _con:
+            _con.commit()
+
+
+def close():
+    global _con
+
+    with _lock:
+        if _con:
+            _con.commit()
+            _con.close()
+            _con = None
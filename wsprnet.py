@@ -0,0 +1,365 @@
+#
+# Fetching spots from wsprnet.org
+#
+
+import codecs
+import concurrent.futures
+from html.parser import HTMLParser
+import httpclient
+import logging
+import requests
+import time
+import urllib.parse
+
+from spot import make_spot, parse_minute, format_minute, parse_freq
+
+
+#
+# Streaming extractor for the spot table of the old database page
+#
+# Feeds the page to an HTMLParser piece by piece and emits the rows of the
+# spot table (the third table on the page) as lists of cell texts when they
+# are parsed, without building a document tree. For the olddb page the rows
+# are the same as from BeautifulSoup's find_all('table')[2] / find_all('td') /
+# .text.strip(), with empty cells and empty rows removed.
+#
+class OlddbTableParser(HTMLParser):
+
+    def __init__(self, table=2):
+        HTMLParser.__init__(self)
+        self.table = table
+        self.tables = 0         # Tables started so far
+        self.depth = 0          # Table depth inside the spot table
+        self.row = None
+        self.cell = None
+        self.rows = []          # Parsed rows not yet emitted
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            if self.depth:
+                self.depth += 1
+            elif self.tables == self.table:
+                self.depth = 1
+            self.tables += 1
+        elif not self.depth:
+            return
+        elif tag == 'tr':
+            self.end_row()
+            self.row = []
+        elif tag == 'td':
+            self.end_cell()
+            if self.row is None:
+                self.row = []
+            self.cell = []
+
+    def handle_endtag(self, tag):
+        if not self.depth:
+            return
+        if tag == 'td':
+            self.end_cell()
+        elif tag == 'tr':
+            self.end_row()
+        elif tag == 'table':
+            self.depth -= 1
+            if not self.depth:
+                self.end_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+    def end_cell(self):
+        if self.cell is not None:
+            text = ''.join(self.cell).strip()
+            if text:
+                self.row.append(text)
+            self.cell = None
+
+    def end_row(self):
+        self.end_cell()
+        if self.row:
+            self.rows.append(self.row)
+        self.row = None
+
+    #
+    # Parse chunks of text, yield rows as they are completed
+    #
+    def parse(self, chunks):
+        for chunk in chunks:
+            self.feed(chunk)
+            if self.rows:
+                yield from self.rows
+                self.rows = []
+        self.close()
+        self.end_row()
+        yield from self.rows
+        self.rows = []
+
+
+#
+# Fetch page from old database and return spots, oldest first
+#
+# Example: 2018-05-28 05:50,OM1AI,7.040137,-15,0,JN88,+23,DA5UDI,JO30qj,724
+#
+def readolddb(wiki):
+    try:
+        with httpclient.get(wiki, stream=True, conditional=True) as page:
+            if page.status_code == 304:
+                # Same page as last time, nothing new
+                return []
+            page.raise_for_status()
+
+            # Decode and parse the page while it is downloaded, within the total timeout
+            decoder = codecs.getincrementaldecoder(page.encoding or 'utf-8')(errors='replace')
+            chunks = (decoder.decode(c) for c in httpclient.iter_body(page, 65536))
+
+            newspots = []
+            for row in OlddbTableParser().parse(chunks):
+                # Strip redundant columns Watt & miles and translate/filter data
+                try:
+                    newspots.append(make_spot(parse_minute(row[0]), row[1], parse_freq(row[2]), int(row[3]), int(row[4]), row[5],
+                                              int(row[6].replace('+','')), row[8], row[9], int(row[10])))
+                except (ValueError, IndexError) as e:
+                    # Like a spot without locator, skip it and keep the rest of the page
+                    logging.info("readolddb() Bad spot row %s: %s", row, e)
+
+            # Whole page parsed, it can be skipped next time if it is the same
+            httpclient.remember(wiki, page)
+    except requests.exceptions.RequestException as e:
+        logging.info("ERROR: %s",e)
+        return []
+
+    # Reverse the sorting order of time to get new spots firsts
+    newspots.reverse()
+
+    return newspots
+
+
+#
+# Get Spots from wsprnet.org
+#
+def getspots (nrspots, band='20', findcall=''):
+    logging.info("getspots() Fetching %d Spots %s from wsprnet.org old database.", nrspots, findcall)
+    # KW force 20m only wiki = "http://wsprnet.org/olddb?mode=html&band=all&limit=" + str(nrspots) + "&findcall=&findreporter=&sort=spotnum"
+    wiki = "http://wsprnet.org/olddb?mode=html&band=" + band + "&limit=" + str(nrspots) + "&findcall=" + urllib.parse.quote(findcall) + "&findreporter=&sort=spotnum"
+    return readolddb(wiki)
+
+#
+# Get Spots from wsprnet.org
+#
+def gettestspots (nrspots, call):
+    logging.info("gettestspots() Fetching %d Spots from wsprnet.org old database.", nrspots)
+    wiki = "http://wsprnet.org/olddb?mode=html&band=20&limit=" + str(nrspots) + "&findcall=" + call + "&findreporter=&sort=spotnum"
+    return readolddb(wiki)
+
+
+#
+# Incremental fetching of new spots
+#
+# The old database can't be asked for spots after a given spot number, only
+# for the latest N spots in spot number order. So the fetcher keeps a
+# watermark of the newest spots it has seen, and asks for about as many
+# spots as have arrived since last fetch, estimated from the arrival rate.
+# If none of the watermark spots are in the page, it didn't reach back to
+# the last fetch and is fetched again with twice the limit, up to max_limit.
+# With no watermark, after a start, a catch-up fetch of catchup spots is done.
+#
+class SpotFetcher:
+
+    def __init__(self, band='20', findcall='', interval=90, min_limit=200, max_limit=10000, catchup=10000, margin=1.5):
+        self.band = band
+        self.findcall = findcall
+        self.interval = interval    # Seconds between fetches
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.catchup = catchup
+        self.margin = margin
+
+        self.limit = catchup
+        self.marks = set()          # Newest spots of last fetch
+        self.watermark = None       # Time of newest spot seen
+        self.rate = None            # Spots per second, moving average
+        self.last_fetch = None
+
+        # Counters
+        self.fetched = 0
+        self.new = 0
+        self.refetches = 0
+        self.gaps = 0
+
+    @staticmethod
+    def key(row):
+        return row
+
+    #
+    # Fetch spots arrived since last fetch. Returned oldest first, like getspots()
+    #
+    def fetch(self):
+        tnow = time.time()
+        limit = self.limit if self.marks else self.catchup
+
+        while True:
+            page = getspots(limit, self.band, self.findcall)
+            if not page:
+                return []
+            self.fetched += len(page)
+
+            # Spots newer than the marks, page is oldest first
+            newspots = []
+            overlap = False
+            for row in reversed(page):
+                if self.key(row) in self.marks:
+                    overlap = True
+                    break
+                newspots.append(row)
+
+            # A short page has all spots the server has, nothing more to fetch
+            if overlap or not self.marks or len(page) < limit:
+                break
+            if limit >= self.max_limit:
+                logging.info("SpotFetcher.fetch() No overlap with last fetch at %d spots, spots may be missed", limit)
+                self.gaps += 1
+                break
+
+            logging.info("SpotFetcher.fetch() No overlap with last fetch at %d spots, fetching more", limit)
+            self.refetches += 1
+            limit = min(limit * 2, self.max_limit)
+
+        newspots.reverse()
+        self.new += len(newspots)
+
+        # Mark the newest few spots, one could be missing next time if deleted
+        self.marks = set(self.key(row) for row in page[-20:])
+        for row in page[-20:]:
+            if self.watermark is None or row.time > self.watermark:
+                self.watermark = row.time
+
+        # Size next fetch from the arrival rate since last fetch
+        if self.last_fetch is not None:
+            rate = len(newspots) / max(tnow - self.last_fetch, 1)
+            self.rate = rate if self.rate is None else 0.7 * self.rate + 0.3 * rate
+            self.limit = int(min(max(self.rate * self.interval * self.margin, self.min_limit), self.max_limit))
+        self.last_fetch = tnow
+
+        logging.info("SpotFetcher.fetch() Band: %s %s Fetched: %d New: %d Watermark: %s", self.band, self.findcall, len(page), len(newspots),
+                     format_minute(self.watermark) if self.watermark is not None else None)
+        return newspots
+
+    #
+    # State to save in a snapshot, and restore from it after a restart
+    #
+    def state(self):
+        return {'marks': self.marks, 'watermark': self.watermark, 'rate': self.rate, 'last_fetch': self.last_fetch}
+
+    def restore(self, state):
+        self.marks = state['marks']
+        self.watermark = state['watermark']
+        self.rate = state['rate']
+        self.last_fetch = state['last_fetch']
+
+        # Size the first fetch for the spots arrived since the snapshot
+        if self.rate is not None and self.last_fetch is not None:
+            elapsed = max(time.time() - self.last_fetch, self.interval)
+            self.limit = int(min(max(self.rate * elapsed * self.margin, self.min_limit), self.max_limit))
+
+    def stats(self):
+        return "Band: %s%s Limit: %5d Rate: %5.1f/min Fetched: %d New: %d Refetches: %d Gaps: %d" % (self.band,
+            (" Call: " + self.findcall) if self.findcall else "", self.limit,
+            (self.rate or 0) * 60, self.fetched, self.new, self.refetches, self.gaps)
+
+
+# Band in MHz, as in balloon.ini, to band parameter of the old database
+mhz2band = {1:'160', 3:'80', 5:'60', 7:'40', 10:'30', 14:'20', 18:'17', 21:'15', 24:'12', 28:'10', 50:'6'}
+
+#
+# Bands to fetch for the balloons in balloon.ini
+#
+def balloon_bands(balloons):
+    bands = []
+    for b in balloons:
+        band = mhz2band.get(b[2])
+        if band is None:
+            logging.info("balloon_bands() Unknown band %s MHz for %s", b[2], b[0])
+        elif band not in bands:
+            bands.append(band)
+    return bands
+
+
+#
+# Queries (band, findcall) for only the spots of the balloons in balloon.ini
+#
+# The balloon calls are asked for as they are. Telemetry calls for channel
+# 0-9 are 0, any, channel, 3 letters and for channel 10-19 Q, any, channel-10,
+# 3 letters. If the server has a single character wildcard, any_char like '_'
+# for SQL LIKE, that is one query per channel. Otherwise they are asked for as
+# one prefix per possible second character followed by wildcard, 36 queries
+# per channel. With the polling every 90 s that is 37 requests per balloon
+# every cycle, against 2 with any_char.
+#
+def balloon_queries(balloons, wildcard='%', any_char=''):
+    queries = []
+    for b in balloons:
+        band = mhz2band.get(b[2])
+        if band is None:
+            logging.info("balloon_queries() Unknown band %s MHz for %s", b[2], b[0])
+            continue
+
+        calls = [b[1]]
+        first = '0' if b[3] < 10 else 'Q'
+        if any_char:
+            calls.append(first + any_char + str(b[3] % 10) + wildcard)
+        else:
+            for c in '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+                calls.append(first + c + str(b[3] % 10) + wildcard)
+
+        for call in calls:
+            if (band, call) not in queries:
+                queries.append((band, call))
+    return queries
+
+
+#
+# Fetch several bands, or several queries, at the same time
+#
+# One SpotFetcher per band or (band, findcall) query, each with its own
+# watermark and limits, fetched concurrently by a small pool of threads. The
+# new spots from all fetchers are merged into one list sorted on time.
+#
+class MultiBandFetcher:
+
+    def __init__(self, queries, workers=4, **kwargs):
+        self.fetchers = []
+        for q in queries:
+            if isinstance(q, tuple):
+                self.fetchers.append(SpotFetcher(band=q[0], findcall=q[1], **kwargs))
+            else:
+                self.fetchers.append(SpotFetcher(band=q, **kwargs))
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(queries))),
+                                                          thread_name_prefix="fetch")
+
+    def fetch(self):
+        results = list(self.pool.map(lambda f: f.fetch(), self.fetchers))
+
+        newspots = []
+        for r in results:
+            newspots.extend(r)
+        newspots.sort(key=lambda row: row.time)
+
+        return newspots
+
+    #
+    # State of all fetchers, keyed on (band, findcall)
+    #
+    def state(self):
+        return {(f.band, f.findcall): f.state() for f in self.fetchers}
+
+    #
+    # Restore fetchers found in state, queries not in it start with a catch-up fetch
+    #
+    def restore(self, state):
+        for f in self.fetchers:
+            if (f.band, f.findcall) in state:
+                f.restore(state[(f.band, f.findcall)])
+
+    def stats(self):
+        return " | ".join(f.stats() for f in self.fetchers)